@@ -22,9 +22,14 @@ EC2/S3 Utility Classes
 import os
 import re
 import time
+import socket
+import thread
+import httplib
 import base64
+import random
 import string
 import tempfile
+import threading
 
 import boto
 import boto.ec2
@@ -38,6 +43,7 @@ from starcluster import utils
 from starcluster import static
 from starcluster import spinner
 from starcluster import sshutils
+from starcluster import spotstore
 from starcluster import webtools
 from starcluster import exception
 from starcluster import progressbar
@@ -45,7 +51,265 @@ from starcluster.utils import print_timing
 from starcluster.logger import log
 
 
+class InstanceCache(object):
+    """
+    Process-wide, thread-safe cache of DescribeInstances results
+
+    Results are keyed by query (instance ids + filters) within a scope (one
+    account/region pair) and expire after ttl seconds. A ttl <= 0 disables
+    caching. Calls that mutate instances must invalidate() their scope.
+    """
+    def __init__(self, ttl=5):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._generations = {}
+
+    @staticmethod
+    def make_key(instance_ids, filters):
+        items = []
+        for name, value in (filters or {}).items():
+            if isinstance(value, (list, tuple, set)):
+                value = tuple(sorted(value))
+            items.append((name, value))
+        return (tuple(sorted(instance_ids or [])), tuple(sorted(items)))
+
+    def generation(self, scope):
+        with self._lock:
+            return self._generations.get(scope, 0)
+
+    def get(self, scope, key):
+        with self._lock:
+            entry = self._entries.get(scope, {}).get(key)
+            if entry and time.time() - entry[0] < self.ttl:
+                self.hits += 1
+                return list(entry[1])
+            self.misses += 1
+
+    def put(self, scope, key, instances, generation=None):
+        """
+        Store instances for key unless the scope was invalidated since
+        generation was read (ie a mutating call raced with the fetch)
+        """
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            if generation is not None and \
+                    generation != self._generations.get(scope, 0):
+                return
+            entries = self._entries.setdefault(scope, {})
+            entries[key] = (time.time(), list(instances))
+
+    def invalidate(self, scope=None):
+        with self._lock:
+            scopes = [scope] if scope else self._entries.keys()
+            for s in scopes:
+                self._entries.pop(s, None)
+                self._generations[s] = self._generations.get(s, 0) + 1
+
+    @property
+    def stats(self):
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, ttl=self.ttl)
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket allowing rate requests per second on average
+    with bursts of up to capacity requests
+    """
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take one token, sleeping until one is available. Returns the number
+        of seconds spent waiting.
+        """
+        waited = 0
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.capacity, self._tokens +
+                                   (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class RequestGovernor(object):
+    """
+    Central governor for all AWS API requests made by EasyAWS connections.
+
+    Requests go through a token bucket per region that is shared by all
+    threads. Requests rejected with RequestLimitExceeded/Throttling are
+    retried with exponential backoff and full jitter. Time spent waiting on
+    the bucket, throttled responses and retries are recorded in stats.
+    """
+    THROTTLE_CODES = ['RequestLimitExceeded', 'Throttling', 'SlowDown']
+
+    def __init__(self, rate=10, burst=40, max_retries=8, base_delay=0.5,
+                 max_delay=30):
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.requests = 0
+        self.throttled = 0
+        self.retries = 0
+        self.wait_time = 0
+        self.backoff_time = 0
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _get_bucket(self, scope):
+        with self._lock:
+            if scope not in self._buckets:
+                self._buckets[scope] = TokenBucket(self.rate, self.burst)
+            return self._buckets[scope]
+
+    def _is_throttled(self, response):
+        if response.status not in (400, 503):
+            return False
+        # boto's HTTPResponse caches the body so callers can still read it
+        body = response.read()
+        return any([code in body for code in self.THROTTLE_CODES])
+
+    def install(self, conn):
+        """
+        Route all requests made by the boto connection conn through this
+        governor (no-op if already installed)
+        """
+        if getattr(conn, '_request_governor', None) is self:
+            return
+        region = getattr(conn, 'region', None)
+        scope = getattr(region, 'name', None) or conn.host
+        make_request = conn.make_request
+
+        def governed_make_request(*args, **kwargs):
+            return self.request(scope, make_request, *args, **kwargs)
+        conn.make_request = governed_make_request
+        conn._request_governor = self
+
+    def request(self, scope, make_request, *args, **kwargs):
+        bucket = self._get_bucket(scope)
+        for attempt in xrange(self.max_retries + 1):
+            waited = bucket.acquire()
+            response = make_request(*args, **kwargs)
+            throttled = self._is_throttled(response)
+            with self._lock:
+                self.requests += 1
+                self.wait_time += waited
+                self.throttled += int(throttled)
+            if not throttled or attempt == self.max_retries:
+                return response
+            delay = random.uniform(0, min(self.max_delay,
+                                          self.base_delay * 2 ** attempt))
+            log.debug("Request throttled by AWS (%s) - retrying in %.1fs" %
+                      (scope, delay))
+            with self._lock:
+                self.retries += 1
+                self.backoff_time += delay
+            time.sleep(delay)
+
+    @property
+    def stats(self):
+        with self._lock:
+            return dict(requests=self.requests, throttled=self.throttled,
+                        retries=self.retries, wait_time=self.wait_time,
+                        backoff_time=self.backoff_time)
+
+
+class ConnectionPool(object):
+    """
+    Thread-local pool of boto connections created alongside a primary one.
+
+    Each thread gets its own connection (and thus its own HTTP keep-alive
+    connections) which it reuses for as long as it lives. Connections of
+    threads that exited are handed out again to new threads and connections
+    that fail with a socket/HTTP error are discarded and replaced on next
+    use. Once max_size connections exist additional threads share the
+    primary connection.
+    """
+    def __init__(self, primary, factory, max_size=20):
+        self.primary = primary
+        self.factory = factory
+        self.max_size = max_size
+        self._conns = {thread.get_ident(): primary}
+        self._idle = []
+        self._lock = threading.Lock()
+        primary._connection_pool = self
+
+    def get(self):
+        ident = thread.get_ident()
+        with self._lock:
+            conn = self._conns.get(ident)
+            if conn is None:
+                conn = self._conns[ident] = self._checkout()
+        return conn
+
+    def _checkout(self):
+        alive = set([t.ident for t in threading.enumerate()])
+        for ident, conn in self._conns.items():
+            if ident not in alive:
+                del self._conns[ident]
+                if conn not in self._conns.values():
+                    self._idle.append(conn)
+        if self._idle:
+            return self._idle.pop()
+        in_use = set([id(c) for c in self._conns.values()])
+        if len(in_use) >= self.max_size:
+            return self.primary
+        log.debug("creating new pooled AWS connection (%d in use)" %
+                  len(in_use))
+        return self._create()
+
+    def _create(self):
+        conn = self.factory()
+        conn._connection_pool = self
+        make_request = conn.make_request
+
+        def make_request_or_discard(*args, **kwargs):
+            try:
+                return make_request(*args, **kwargs)
+            except (socket.error, httplib.HTTPException):
+                self.discard(conn)
+                raise
+        conn.make_request = make_request_or_discard
+        return conn
+
+    def discard(self, conn):
+        """
+        Stop handing out conn. Threads using it get a new connection on
+        their next request. The primary connection is never discarded.
+        """
+        if conn is self.primary:
+            return
+        with self._lock:
+            for ident, c in self._conns.items():
+                if c is conn:
+                    del self._conns[ident]
+            if conn in self._idle:
+                self._idle.remove(conn)
+
+
 class EasyAWS(object):
+    # shared by all connections so that the limits apply process-wide
+    request_governor = RequestGovernor()
+    # maximum number of connections per EasyAWS object (one per thread)
+    connection_pool_size = 20
+
     def __init__(self, aws_access_key_id, aws_secret_access_key,
                  connection_authenticator, **kwargs):
         """
@@ -69,41 +333,189 @@ class EasyAWS(object):
         self._conn = None
         return self.conn
 
+    def _create_connection(self):
+        log.debug('creating connection w/ connection_authenticator ' +
+                  'kwargs = %s' % self._kwargs)
+        validate_certs = self._kwargs.get('validate_certs', True)
+        if validate_certs:
+            if not HAVE_HTTPS_CONNECTION:
+                raise exception.AWSError(
+                    "Failed to validate AWS SSL certificates. "
+                    "SSL certificate validation is only supported "
+                    "on Python>=2.6.\n\nSet AWS_VALIDATE_CERTS=False in "
+                    "the [aws info] section of your config to skip SSL "
+                    "certificate verification and suppress this error AT "
+                    "YOUR OWN RISK.")
+        if not boto_config.has_section('Boto'):
+            boto_config.add_section('Boto')
+        # Hack to get around the fact that boto ignores validate_certs
+        # if https_validate_certificates is declared in the boto config
+        boto_config.setbool('Boto', 'https_validate_certificates',
+                            validate_certs)
+        conn = self.connection_authenticator(
+            self.aws_access_key_id, self.aws_secret_access_key,
+            **self._kwargs)
+        conn.https_validate_certificates = validate_certs
+        return conn
+
     @property
     def conn(self):
+        """
+        Returns the calling thread's connection. Connections created by this
+        object are pooled (see ConnectionPool) so that each thread gets its
+        own. A connection passed in by the caller is shared by all threads
+        unless it belongs to a pool.
+        """
         if self._conn is None:
-            log.debug('creating self._conn w/ connection_authenticator ' +
-                      'kwargs = %s' % self._kwargs)
-            validate_certs = self._kwargs.get('validate_certs', True)
-            if validate_certs:
-                if not HAVE_HTTPS_CONNECTION:
-                    raise exception.AWSError(
-                        "Failed to validate AWS SSL certificates. "
-                        "SSL certificate validation is only supported "
-                        "on Python>=2.6.\n\nSet AWS_VALIDATE_CERTS=False in "
-                        "the [aws info] section of your config to skip SSL "
-                        "certificate verification and suppress this error AT "
-                        "YOUR OWN RISK.")
-            if not boto_config.has_section('Boto'):
-                boto_config.add_section('Boto')
-            # Hack to get around the fact that boto ignores validate_certs
-            # if https_validate_certificates is declared in the boto config
-            boto_config.setbool('Boto', 'https_validate_certificates',
-                                validate_certs)
-            self._conn = self.connection_authenticator(
-                self.aws_access_key_id, self.aws_secret_access_key,
-                **self._kwargs)
-            self._conn.https_validate_certificates = validate_certs
-        return self._conn
+            self._conn = self._create_connection()
+            ConnectionPool(self._conn, self._create_connection,
+                           self.connection_pool_size)
+        pool = getattr(self._conn, '_connection_pool', None)
+        conn = pool.get() if pool else self._conn
+        self.request_governor.install(conn)
+        return conn
+
+
+class PropagationWaiter(object):
+    """
+    Waits for newly created AWS objects to show up in the API.
+
+    Any mix of instances, spot requests, volumes, snapshots and images can
+    be added. Each poll fetches all pending objects of a kind with one
+    describe call (per chunk_size ids) and polling starts every
+    min_interval seconds, backing off up to max_interval seconds. Objects
+    are resolved as soon as they appear (see iter_resolved).
+    """
+    KINDS = {
+        'spot': ('spot-instance-request-id', 'spot requests'),
+        'instance': ('instance-id', 'instances'),
+        'volume': ('volume-id', 'volumes'),
+        'snapshot': ('snapshot-id', 'snapshots'),
+        'image': ('image-id', 'images'),
+    }
+
+    def __init__(self, ec2, min_interval=1, max_interval=15, backoff=1.5,
+                 timeout=300, chunk_size=200):
+        self.ec2 = ec2
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.backoff = backoff
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.pending = dict([(kind, []) for kind in self.KINDS])
+        self.resolved = dict([(kind, {}) for kind in self.KINDS])
+
+    def _fetch(self, kind, filters):
+        if kind == 'spot':
+            return self.ec2.get_all_spot_requests(filters=filters)
+        elif kind == 'instance':
+            return self.ec2.get_all_instances(filters=filters,
+                                              use_cache=False)
+        elif kind == 'volume':
+            return self.ec2.get_volumes(filters=filters)
+        elif kind == 'snapshot':
+            return self.ec2.get_snapshots(filters=filters)
+        elif kind == 'image':
+            return self.ec2.get_images(filters=filters)
+
+    def add(self, kind, objs):
+        """
+        Add objects (or object ids) of the given kind to wait for
+        """
+        pending = self.pending[kind]
+        for obj in objs:
+            oid = getattr(obj, 'id', obj)
+            if oid and oid not in self.resolved[kind] and oid not in pending:
+                pending.append(oid)
+
+    @property
+    def num_pending(self):
+        return sum([len(ids) for ids in self.pending.values()])
+
+    def check(self):
+        """
+        Poll once for all pending objects. Returns a list of (kind, obj)
+        tuples for the objects that were resolved by this poll.
+        """
+        found = []
+        for kind, ids in self.pending.items():
+            if not ids:
+                continue
+            id_filter = self.KINDS[kind][0]
+            resolved = self.resolved[kind]
+            pending = set(ids)
+            for chunk in utils.chunk_list(ids, self.chunk_size):
+                for obj in self._fetch(kind, {id_filter: chunk}):
+                    if obj.id in pending and obj.id not in resolved:
+                        resolved[obj.id] = obj
+                        found.append((kind, obj))
+            self.pending[kind] = [i for i in ids if i not in resolved]
+        return found
+
+    def iter_resolved(self):
+        """
+        Poll until all pending objects are resolved, yielding (kind, obj)
+        tuples as soon as each object shows up. Raises PropagationException
+        if objects are still missing after timeout seconds.
+        """
+        start = time.time()
+        interval = self.min_interval
+        while True:
+            for item in self.check():
+                yield item
+            if not self.num_pending:
+                return
+            elapsed = time.time() - start
+            if elapsed >= self.timeout:
+                break
+            log.debug("%d objects have not propagated yet - sleeping %.1fs" %
+                      (self.num_pending, interval))
+            time.sleep(min(interval, self.timeout - elapsed))
+            interval = min(self.max_interval, interval * self.backoff)
+        missing = []
+        for kind, ids in self.pending.items():
+            if ids:
+                missing.append("%s: %s" % (self.KINDS[kind][1],
+                                           ', '.join(ids)))
+        raise exception.PropagationException(
+            "Failed to fetch %d objects after %d seconds (%s)" %
+            (self.num_pending, self.timeout, '; '.join(missing)))
+
+    def wait(self):
+        """
+        Wait for all pending objects to propagate while showing progress
+        """
+        num_objs = self.num_pending
+        if not num_objs:
+            return
+        names = [self.KINDS[kind][1] for kind, ids in
+                 sorted(self.pending.items()) if ids]
+        widgets = ['', progressbar.Fraction(), ' ',
+                   progressbar.Bar(marker=progressbar.RotatingMarker()), ' ',
+                   progressbar.Percentage(), ' ', ' ']
+        log.info("Waiting for %s to propagate..." % ' and '.join(names))
+        pbar = progressbar.ProgressBar(widgets=widgets,
+                                       maxval=num_objs).start()
+        try:
+            for i, item in enumerate(self.iter_resolved()):
+                pbar.update(i + 1)
+        finally:
+            if not pbar.finished:
+                pbar.finish()
 
 
 class EasyEC2(EasyAWS):
+    # shared by all EasyEC2 objects, including the ones created per Node
+    instance_cache = InstanceCache()
+
     def __init__(self, aws_access_key_id, aws_secret_access_key,
                  aws_ec2_path='/', aws_s3_host=None, aws_s3_path='/',
                  aws_port=None, aws_region_name=None, aws_is_secure=True,
                  aws_region_host=None, aws_proxy=None, aws_proxy_port=None,
                  aws_proxy_user=None, aws_proxy_pass=None,
-                 aws_validate_certs=True, **kwargs):
+                 aws_validate_certs=True, aws_instance_cache_ttl=None,
+                 aws_request_rate=None, aws_request_burst=None,
+                 aws_max_connections=None, **kwargs):
         aws_region = None
         if aws_region_name and aws_region_host:
             aws_region = boto.ec2.regioninfo.RegionInfo(
@@ -115,6 +527,8 @@ class EasyEC2(EasyAWS):
                     validate_certs=aws_validate_certs)
         super(EasyEC2, self).__init__(aws_access_key_id, aws_secret_access_key,
                                       boto.connect_vpc, **kwds)
+        if aws_max_connections is not None:
+            self.connection_pool_size = aws_max_connections
         self._conn = kwargs.get('connection')
         kwds = dict(aws_s3_host=aws_s3_host, aws_s3_path=aws_s3_path,
                     aws_port=aws_port, aws_is_secure=aws_is_secure,
@@ -126,10 +540,29 @@ class EasyEC2(EasyAWS):
         self._regions = None
         self._account_attrs = None
         self._account_attrs_region = None
+        if aws_instance_cache_ttl is not None:
+            self.instance_cache.ttl = aws_instance_cache_ttl
+        if aws_request_rate is not None:
+            self.request_governor.rate = aws_request_rate
+        if aws_request_burst is not None:
+            self.request_governor.burst = aws_request_burst
+        self.spot_store = spotstore.SpotPriceStore()
 
     def __repr__(self):
         return '<EasyEC2: %s (%s)>' % (self.region.name, self.region.endpoint)
 
+    @property
+    def _cache_scope(self):
+        return (self.aws_access_key_id, self.region.name)
+
+    def invalidate_instance_cache(self):
+        """
+        Drop cached DescribeInstances results for this account/region. Must
+        be called after any call that launches, terminates, stops, starts,
+        reboots or (re)tags instances.
+        """
+        self.instance_cache.invalidate(self._cache_scope)
+
     def _fetch_account_attrs(self):
         acct_attrs = self._account_attrs
         if not acct_attrs or self._account_attrs_region != self.region.name:
@@ -536,97 +969,53 @@ class EasyEC2(EasyAWS):
                                network_interfaces=None):
         kwargs = locals()
         kwargs.pop('self')
-        return self.conn.request_spot_instances(**kwargs)
-
-    def _wait_for_propagation(self, obj_ids, fetch_func, id_filter, obj_name,
-                              max_retries=60, interval=5):
-        """
-        Wait for a list of object ids to appear in the AWS API. Requires a
-        function that fetches the objects and also takes a filters kwarg. The
-        id_filter specifies the id filter to use for the objects and
-        obj_name describes the objects for log messages.
-        """
-        filters = {id_filter: obj_ids}
-        num_objs = len(obj_ids)
-        num_reqs = 0
-        reqs_ids = []
-        max_retries = max(1, max_retries)
-        interval = max(1, interval)
-        widgets = ['', progressbar.Fraction(), ' ',
-                   progressbar.Bar(marker=progressbar.RotatingMarker()), ' ',
-                   progressbar.Percentage(), ' ', ' ']
-        log.info("Waiting for %s to propagate..." % obj_name)
-        pbar = progressbar.ProgressBar(widgets=widgets,
-                                       maxval=num_objs).start()
         try:
-            for i in range(max_retries + 1):
-                reqs = fetch_func(filters=filters)
-                reqs_ids = [req.id for req in reqs]
-                num_reqs = len(reqs)
-                pbar.update(num_reqs)
-                if num_reqs != num_objs:
-                    log.debug("%d: only %d/%d %s have "
-                              "propagated - sleeping..." %
-                              (i, num_reqs, num_objs, obj_name))
-                    if i != max_retries:
-                        time.sleep(interval)
-                else:
-                    return
+            return self.conn.request_spot_instances(**kwargs)
         finally:
-            if not pbar.finished:
-                pbar.finish()
-        missing = [oid for oid in obj_ids if oid not in reqs_ids]
-        raise exception.PropagationException(
-            "Failed to fetch %d/%d %s after %d seconds: %s" %
-            (num_reqs, num_objs, obj_name, max_retries * interval,
-             ', '.join(missing)))
+            self.invalidate_instance_cache()
+
+    def get_propagation_waiter(self, **kwargs):
+        """
+        Returns a new PropagationWaiter for this connection (see
+        PropagationWaiter for kwargs)
+        """
+        return PropagationWaiter(self, **kwargs)
 
     def wait_for_propagation(self, instances=None, spot_requests=None,
-                             max_retries=60, interval=5):
-        """
-        Wait for newly created instances and/or spot_requests to register in
-        the AWS API by repeatedly calling get_all_{instances, spot_requests}.
-        Calling this method directly after creating new instances or spot
-        requests before operating on them helps to avoid eventual consistency
-        errors about instances or spot requests not existing.
-        """
-        if spot_requests:
-            spot_ids = [getattr(s, 'id', s) for s in spot_requests]
-            self._wait_for_propagation(
-                spot_ids, self.get_all_spot_requests,
-                'spot-instance-request-id', 'spot requests',
-                max_retries=max_retries, interval=interval)
-        if instances:
-            instance_ids = [getattr(i, 'id', i) for i in instances]
-            self._wait_for_propagation(
-                instance_ids, self.get_all_instances, 'instance-id',
-                'instances', max_retries=max_retries, interval=interval)
-
-    def _check_for_propagation(self, obj_ids, fetch_func, id_filter, obj_name):
-        filters = {id_filter: obj_ids}
-        reqs_ids = []
-        reqs = fetch_func(filters=filters)
-        reqs_ids = [req.id for req in reqs]
-        found = [oid for oid in obj_ids if oid in reqs_ids]
-        return found
+                             max_retries=60, interval=5, volumes=None,
+                             snapshots=None, images=None):
+        """
+        Wait for newly created instances, spot_requests, volumes, snapshots
+        and/or images to register in the AWS API. All objects are polled
+        together, starting fast and backing off up to interval seconds for a
+        total of max_retries * interval seconds. Calling this method directly
+        after creating new objects before operating on them helps to avoid
+        eventual consistency errors about objects not existing.
+        """
+        waiter = self.get_propagation_waiter(max_interval=interval,
+                                             timeout=max_retries * interval)
+        waiter.add('spot', spot_requests or [])
+        waiter.add('instance', instances or [])
+        waiter.add('volume', volumes or [])
+        waiter.add('snapshot', snapshots or [])
+        waiter.add('image', images or [])
+        waiter.wait()
 
     def check_for_propagation(self, instance_ids=None, spot_ids=None):
         """
         Check propagated instances. Returns a tuple where the first item is
-        a list of the found instances and the second a list of the found
-        spot requests.
-        """
-        found_instance_ids = []
-        found_spot_ids = []
-        if spot_ids:
-            found_instance_ids = self._check_for_propagation(
-                spot_ids, self.get_all_spot_requests,
-                'spot-instance-request-id', 'spot requests')
-        if instance_ids:
-            found_spot_ids = self._check_for_propagation(
-                instance_ids, self.get_all_instances, 'instance-id',
-                'instances')
-        return found_instance_ids, found_spot_ids
+        a list of the found spot requests and the second a list of the found
+        instances.
+        """
+        waiter = self.get_propagation_waiter()
+        waiter.add('spot', spot_ids or [])
+        waiter.add('instance', instance_ids or [])
+        waiter.check()
+        found_spot_ids = [s for s in spot_ids or []
+                          if s in waiter.resolved['spot']]
+        found_instance_ids = [i for i in instance_ids or []
+                              if i in waiter.resolved['instance']]
+        return found_spot_ids, found_instance_ids
 
     def run_instances(self, image_id, instance_type='m1.small', min_count=1,
                       max_count=1, key_name=None, security_groups=None,
@@ -649,10 +1038,12 @@ class EasyEC2(EasyAWS):
             kwargs.update(
                 security_group_ids=self.get_securityids_from_names(
                     security_groups))
-            return self.conn.run_instances(image_id, **kwargs)
         else:
             kwargs.update(security_groups=security_groups)
+        try:
             return self.conn.run_instances(image_id, **kwargs)
+        finally:
+            self.invalidate_instance_cache()
 
     def create_image(self, instance_id, name, description=None,
                      no_reboot=False):
@@ -741,6 +1132,38 @@ class EasyEC2(EasyAWS):
                             img.location.split('/')[-1])
         return image_name
 
+    def create_tags(self, resources, tags, chunk_size=1000, tries=5):
+        """
+        Apply the same tags (dict) to many resources (ids or boto objects
+        such as instances or nodes) with one CreateTags request per
+        chunk_size resources rather than one request per resource and tag.
+        The tags of the given objects are updated locally as well.
+
+        Resources that were just created may not have propagated yet so
+        NotFound errors are retried up to tries times.
+        """
+        resource_ids = [getattr(r, 'id', r) for r in resources]
+        if not resource_ids or not tags:
+            return
+        try:
+            for ids in utils.chunk_list(resource_ids, chunk_size):
+                for i in xrange(tries):
+                    try:
+                        self.conn.create_tags(ids, tags)
+                        break
+                    except boto.exception.EC2ResponseError as e:
+                        if i == tries - 1 or \
+                                not e.error_code.endswith('.NotFound'):
+                            raise
+                        log.debug("%s: retrying create_tags (tries: %s)" %
+                                  (e.error_code, i + 1))
+                        time.sleep(i + 1)
+        finally:
+            self.invalidate_instance_cache()
+        for r in resources:
+            if getattr(r, 'tags', None) is not None:
+                r.tags.update(tags)
+
     def get_instance_user_data(self, instance_id):
         try:
             attrs = self.conn.get_instance_attribute(instance_id, 'userData')
@@ -756,7 +1179,14 @@ class EasyEC2(EasyAWS):
                         self.get_all_security_groups(groupnames)])
         return [name_id[gname] for gname in groupnames if gname in name_id]
 
-    def get_all_instances(self, instance_ids=None, filters=None):
+    def get_all_instances(self, instance_ids=None, filters=None,
+                          use_cache=True):
+        """
+        Returns a flat list of instances matching instance_ids/filters.
+        Results are served from the shared instance cache when a matching
+        query was made less than instance_cache.ttl seconds ago unless
+        use_cache is False.
+        """
         if instance_ids is None:
             instance_ids = []
         if filters is None:
@@ -773,6 +1203,13 @@ class EasyEC2(EasyAWS):
                 return []  # Haven't created the security group in aws yet
             del filters['group-name']
 
+        scope = self._cache_scope
+        key = self.instance_cache.make_key(instance_ids, filters)
+        if use_cache:
+            cached = self.instance_cache.get(scope, key)
+            if cached is not None:
+                return cached
+        generation = self.instance_cache.generation(scope)
         for i in xrange(5):
             try:
                 reservations = self.conn.get_all_instances(instance_ids,
@@ -797,7 +1234,12 @@ class EasyEC2(EasyAWS):
         instances = []
         for res in reservations:
             insts = res.instances
+            for inst in insts:
+                # boto does not keep the reservation on the instance. nodes
+                # use it to share user data launched in the same request
+                inst.reservation_id = res.id
             instances.extend(insts)
+        self.instance_cache.put(scope, key, instances, generation)
         return instances
 
     def get_instance(self, instance_id):
@@ -828,6 +1270,16 @@ class EasyEC2(EasyAWS):
                                                          filters=filters)
         return spots
 
+    def cancel_spot_requests(self, spot_ids):
+        """
+        Cancel the spot requests spot_ids with a single request
+        """
+        if spot_ids:
+            try:
+                self.conn.cancel_spot_instance_requests(spot_ids)
+            finally:
+                self.invalidate_instance_cache()
+
     def list_all_spot_instances(self, show_closed=False):
         s = self.conn.get_all_spot_instance_requests()
         if not s:
@@ -1383,7 +1835,10 @@ class EasyEC2(EasyAWS):
 
     def terminate_instances(self, instances=None):
         if instances:
-            self.conn.terminate_instances(instances)
+            try:
+                self.conn.terminate_instances(instances)
+            finally:
+                self.invalidate_instance_cache()
 
     def get_volumes(self, filters=None):
         """
@@ -1556,6 +2011,21 @@ class EasyEC2(EasyAWS):
                 print
         print 'Total: %s' % len(vols)
 
+    def _get_spot_price_history(self, **kwargs):
+        """
+        Same as conn.get_spot_price_history but follows next_token to return
+        every page of results
+        """
+        hist = []
+        next_token = None
+        while True:
+            page = self.conn.get_spot_price_history(next_token=next_token,
+                                                    **kwargs)
+            hist.extend(page)
+            next_token = getattr(page, 'next_token', None)
+            if not next_token:
+                return hist
+
     def get_spot_history(self, instance_type, start=None, end=None, zone=None,
                          plot=False, plot_server_interface="localhost",
                          plot_launch_browser=True, plot_web_browser=None,
@@ -1583,18 +2053,23 @@ class EasyEC2(EasyAWS):
             short_pdesc = "VPC"
         log_info("Fetching spot history for %s (%s)" %
                  (instance_type, short_pdesc))
-        hist = self.conn.get_spot_price_history(start_time=start, end_time=end,
-                                                availability_zone=zone,
-                                                instance_type=instance_type,
-                                                product_description=pdesc)
+
+        def fetch(start_time, end_time):
+            return self._get_spot_price_history(
+                start_time=start_time, end_time=end_time,
+                availability_zone=zone, instance_type=instance_type,
+                product_description=pdesc)
+        hist = self.spot_store.get_history(
+            fetch, self.region.name, instance_type, pdesc, zone=zone,
+            start=start and utils.iso_to_unix_time(start),
+            end=end and utils.iso_to_unix_time(end))
         if not hist:
             raise exception.SpotHistoryError(start, end)
         dates = []
         prices = []
         data = []
-        for item in hist:
-            timestamp = utils.iso_to_javascript_timestamp(item.timestamp)
-            price = item.price
+        for secs, price, item_zone in hist:
+            timestamp = secs * 1000
             dates.append(timestamp)
             prices.append(price)
             data.append([timestamp, price])
@@ -1613,7 +2088,8 @@ class EasyEC2(EasyAWS):
             ypanrange = [minimum - yaxisrange / 2., maximum + yaxisrange / 2.]
             yzoomrange = [0.1, ypanrange[-1] - ypanrange[0]]
             context = dict(instance_type=instance_type,
-                           start=hist[-1].timestamp, end=hist[0].timestamp,
+                           start=utils.unix_time_to_iso(hist[-1][0]),
+                           end=utils.unix_time_to_iso(hist[0][0]),
                            time_series_data=str(data).replace('L', ''),
                            shutdown=plot_shutdown_server,
                            xpanrange=xpanrange, ypanrange=ypanrange,
@@ -1646,28 +2122,70 @@ class EasyEC2(EasyAWS):
         else:
             log.info("No console output available...")
 
-    def get_spot_cheapest_zone(self, instance_type, zone_filter, vpc=False):
+    def get_spot_prices(self, instance_types, zone_filter=None, vpc=False):
+        """
+        Returns the current spot price of every (instance type, zone) pair as
+        a matrix: {instance_type: {zone: price}}. The prices of all types
+        and zones are fetched with a single (paginated) spot price history
+        query. Zones without a price for a given type map to None.
+
+        zone_filter, if a list, zones to consider, if None, all zones
+            considered
+        """
+        if not vpc:
+            vpc = self.default_vpc is not None
+        pdesc = "Linux/UNIX (Amazon VPC)" if vpc else "Linux/UNIX"
+        zones = []
+        for zone in self.conn.get_all_zones():
+            if zone_filter is not None and zone.name not in zone_filter:
+                log.debug("Filtered zone {}".format(zone.name))
+                continue
+            zones.append(zone.name)
+        filters = {'instance-type': list(instance_types)}
+        if zone_filter is not None:
+            filters['availability-zone'] = zones
+        # with start_time == end_time EC2 returns the price in effect at
+        # that time for every matching type/zone
+        now = utils.get_utc_now(iso=True)
+        hist = self._get_spot_price_history(
+            start_time=now, end_time=now, product_description=pdesc,
+            filters=filters)
+        prices = dict([(itype, dict.fromkeys(zones)) for itype in
+                       instance_types])
+        latest = {}
+        for item in hist:
+            key = (item.instance_type, item.availability_zone)
+            if item.instance_type not in prices or \
+                    item.availability_zone not in zones:
+                continue
+            timestamp = utils.iso_to_unix_time(item.timestamp)
+            if key not in latest or timestamp > latest[key]:
+                latest[key] = timestamp
+                prices[item.instance_type][item.availability_zone] = \
+                    item.price
+        return prices
+
+    def get_spot_cheapest_zone(self, instance_type, zone_filter, vpc=False,
+                               prices=None):
         """
         Find cheapest zone.
 
         zone_filter, if a list, zones to consider, if None, all zones
             considered
+        prices, optional price matrix returned by get_spot_prices to pick
+            from instead of querying EC2
         """
+        if prices is None:
+            prices = self.get_spot_prices([instance_type], zone_filter,
+                                          vpc=vpc)
         min_price = 9999
         min_zone = None
-        for zone in self.conn.get_all_zones():
-            zone_name = zone.name
-            if zone_filter is not None and zone_name not in zone_filter:
-                log.debug("Filtered zone {}".format(zone_name))
+        for zone_name, price in sorted(prices[instance_type].items()):
+            if price is None:
+                # can be normal when amazon adds zones
+                log.warning("No spot price found for %s in %s" %
+                            (instance_type, zone_name))
                 continue
-            try:
-                price = self.get_spot_history(instance_type,
-                                              zone=zone_name,
-                                              mute=True, vpc=vpc)
-                price = price[0][1]
-            except exception.SpotHistoryError as err:
-                log.warning(str(err))  # can be normal when amazon adds zones
-                price = 9999999
             log.debug("%s: %f", zone_name, price)
             if price < min_price:
                 min_zone = zone_name
@@ -146,15 +146,17 @@ class SGEStats(object):
         """
         This method parses qacct -j output and makes a neat array and
         calculates some statistics.
-        Takes the string to parse, and a datetime object of the remote
-        host's current time.
+        Takes the string (or an iterable of lines) to parse, and a datetime
+        object of the remote host's current time.
         """
         job_id = None
         qd = None
         start = None
         end = None
         counter = 0
-        lines = string.split('\n')
+        lines = string
+        if isinstance(string, basestring):
+            lines = string.split('\n')
         for l in lines:
             l = l.strip()
             if l.find('jobnumber') != -1:
@@ -553,21 +555,20 @@ class SGELoadBalancer(LoadBalancer):
         qatime = self.get_qatime(now)
         qacct_cmd = 'qacct -j -b ' + qatime
         qstat_cmd = 'qstat -u \* -xml -f -r'
-        qhostxml = '\n'.join(master.ssh.execute('qhost -xml'))
-        qstatxml = '\n'.join(master.ssh.execute(qstat_cmd))
+        qhostxml = ''.join(master.ssh.execute_iter('qhost -xml'))
+        qstatxml = ''.join(master.ssh.execute_iter(qstat_cmd))
+        self.stat.parse_qhost(qhostxml)
+        self.stat.parse_qstat(qstatxml)
+        log.debug("sizes: qhost: %d, qstat: %d" % (len(qhostxml),
+                                                   len(qstatxml)))
+        # qacct output can be huge so parse it as it arrives
         try:
-            qacct = '\n'.join(master.ssh.execute(qacct_cmd))
+            self.stat.parse_qacct(master.ssh.execute_iter(qacct_cmd), now)
         except exception.RemoteCommandFailed:
             if master.ssh.isfile('/opt/sge6/default/common/accounting'):
                 raise
             else:
                 log.info("No jobs have completed yet!")
-                qacct = ''
-        self.stat.parse_qhost(qhostxml)
-        self.stat.parse_qstat(qstatxml)
-        self.stat.parse_qacct(qacct, now)
-        log.debug("sizes: qhost: %d, qstat: %d, qacct: %d" %
-                  (len(qhostxml), len(qstatxml), len(qacct)))
         return self.stat
 
     @utils.print_timing("Fetching SGE stats", debug=True)
@@ -803,29 +804,35 @@ class SGELoadBalancer(LoadBalancer):
         remove_nodes = self._find_nodes_for_removal(max_remove=max_remove)
         if not remove_nodes:
             log.info("No nodes can be removed at this time")
+        self._cluster.refresh_nodes(remove_nodes)
+        running_nodes = []
         for node in remove_nodes:
-            if node.update() != "running":
+            if node.state != "running":
                 log.error("Node %s is already dead - not removing" %
                           node.alias)
                 continue
             log.warn("Removing %s: %s (%s)" %
                      (node.alias, node.id, node.dns_name))
-            try:
-                self._cluster.remove_node(node)
-                self.__last_cluster_mod_time = utils.get_utc_now()
-            except ThreadPoolException as tpe:
-                traceback.print_exc()
-                log.error("Failed to remove node %s" % node.alias,
-                          exc_info=True)
-                log.debug(traceback.format_exc())
-                log.error("Individual errors follow")
-                for exc in tpe.exceptions:
-                    print exc[1]
-            except Exception:
-                traceback.print_exc()
-                log.error("Failed to remove node %s" % node.alias,
-                          exc_info=True)
-                log.debug(traceback.format_exc())
+            running_nodes.append(node)
+        if not running_nodes:
+            return
+        aliases = ', '.join([n.alias for n in running_nodes])
+        try:
+            self._cluster.remove_nodes(nodes=running_nodes)
+            self.__last_cluster_mod_time = utils.get_utc_now()
+        except ThreadPoolException as tpe:
+            traceback.print_exc()
+            log.error("Failed to remove node(s) %s" % aliases,
+                      exc_info=True)
+            log.debug(traceback.format_exc())
+            log.error("Individual errors follow")
+            for exc in tpe.exceptions:
+                print exc[1]
+        except Exception:
+            traceback.print_exc()
+            log.error("Failed to remove node(s) %s" % aliases,
+                      exc_info=True)
+            log.debug(traceback.format_exc())
 
     def _eval_terminate_cluster(self):
         """
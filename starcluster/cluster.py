@@ -17,15 +17,20 @@
 
 import os
 import re
+import sys
 import time
+import Queue
 import string
 import pprint
 import warnings
 import datetime
+import copy
 import json
+import threading
 from collections import Counter
 
 import iptools
+from boto.exception import EC2ResponseError
 
 from starcluster import utils
 from starcluster import static
@@ -37,14 +42,18 @@ from starcluster import exception
 from starcluster import threadpool
 from starcluster import validators
 from starcluster import progressbar
+from starcluster import receiptcache
 from starcluster import clustersetup
 from starcluster.node import Node
 from starcluster.node import NodeManager
+from starcluster.node import NodeRecoveryManager
+from starcluster.node import SSHProber
 from starcluster.plugins import sge
 from starcluster.utils import print_timing
 from starcluster.templates import user_msgs
 from starcluster.logger import log
 from starcluster.streaming_node_add import streaming_add
+from starcluster.streaming_node_add import StreamingClusterStart
 
 
 class ClusterManager(managers.Manager):
@@ -55,9 +64,13 @@ class ClusterManager(managers.Manager):
         return "<ClusterManager: %s>" % self.ec2.region.name
 
     def get_cluster(self, cluster_name, group=None, load_receipt=True,
-                    load_plugins=True, load_volumes=True, require_keys=True):
+                    load_plugins=True, load_volumes=True, require_keys=True,
+                    snapshot=None):
         """
         Returns a Cluster object representing an active cluster
+
+        snapshot - optional (instances, spot_requests) of the cluster to use
+        instead of querying EC2 (see get_fleet_snapshot)
         """
         try:
             clname = self._get_cluster_name(cluster_name)
@@ -66,6 +79,8 @@ class ClusterManager(managers.Manager):
                 group = self.ec2.get_security_group(clname)
             cl = Cluster(ec2_conn=self.ec2, cluster_tag=cltag,
                          cluster_group=group)
+            if snapshot:
+                cl.load_snapshot(*snapshot)
 
             # Useful when config is on master node
             try:
@@ -197,7 +212,7 @@ class ClusterManager(managers.Manager):
     def add_nodes(self, cluster_name, num_nodes, aliases=None, no_create=False,
                   image_id=None, instance_type=None, zone=None,
                   placement_group=None, spot_bid=None, reboot_interval=10,
-                  n_reboot_restart=False):
+                  n_reboot_restart=False, timeline_file=None):
         """
         Add one or more nodes to cluster
         """
@@ -207,7 +222,8 @@ class ClusterManager(managers.Manager):
                             placement_group=placement_group, spot_bid=spot_bid,
                             no_create=no_create,
                             reboot_interval=reboot_interval,
-                            n_reboot_restart=n_reboot_restart)
+                            n_reboot_restart=n_reboot_restart,
+                            timeline_file=timeline_file)
 
     def remove_node(self, cluster_name, alias=None, terminate=True,
                     force=False):
@@ -293,9 +309,58 @@ class ClusterManager(managers.Manager):
             raise ValueError("Invalid cluster group name: %s" % sg)
         return tag
 
-    def list_clusters(self, cluster_groups=None, show_ssh_status=False):
-        """
-        Prints a summary for each active cluster on EC2
+    def get_fleet_snapshot(self, cluster_groups):
+        """
+        Returns {group_id: (instances, spot_requests)} with the pending and
+        running instances and the active and open spot requests of each
+        cluster group using a single DescribeInstances and a single
+        DescribeSpotInstanceRequests call for all clusters (plus one call
+        per VPC cluster if there are spot requests launched in subnets)
+        """
+        snapshot = dict([(g.id, ([], [])) for g in cluster_groups])
+        filters = {'instance-state-name': ['pending', 'running']}
+        for inst in self.ec2.get_all_instances(filters=filters):
+            for group in inst.groups:
+                if group.id in snapshot:
+                    snapshot[group.id][0].append(inst)
+        filters = {'state': ['active', 'open']}
+        ungrouped = False
+        for spot in self.ec2.get_all_spot_requests(filters=filters):
+            groups = getattr(spot.launch_specification, 'groups', None)
+            if not groups:
+                ungrouped = True
+            for group in groups or []:
+                if group.id in snapshot:
+                    snapshot[group.id][1].append(spot)
+        if ungrouped:
+            # boto does not report the groups of spot requests launched
+            # with network interfaces (VPC subnets) so look those up by
+            # their network interfaces' groups
+            for group in cluster_groups:
+                if not group.vpc_id:
+                    continue
+                spots = snapshot[group.id][1]
+                spot_ids = [s.id for s in spots]
+                filters = {'state': ['active', 'open'],
+                           'network-interface.group-id': group.id}
+                for spot in self.ec2.get_all_spot_requests(filters=filters):
+                    if spot.id not in spot_ids:
+                        spots.append(spot)
+        return snapshot
+
+    def list_clusters(self, cluster_groups=None, show_ssh_status=False,
+                      ssh_timeout=10, ssh_port_only=False,
+                      ssh_concurrency=20):
+        """
+        Prints a summary for each active cluster on EC2. The instances and
+        spot requests of all clusters are fetched at once (see
+        get_fleet_snapshot).
+
+        With show_ssh_status the SSH status of all nodes is probed in the
+        background, at most ssh_concurrency nodes at a time with a timeout
+        of ssh_timeout seconds, and printed as the probes complete.
+        ssh_port_only only checks that the SSH port accepts connections
+        instead of authenticating.
         """
         if not cluster_groups:
             cluster_groups = self.get_cluster_security_groups()
@@ -307,14 +372,29 @@ class ClusterManager(managers.Manager):
                                   in cluster_groups]
             except exception.SecurityGroupDoesNotExist:
                 raise exception.ClusterDoesNotExist(g)
+        snapshot = self.get_fleet_snapshot(cluster_groups)
+        clusters = []
         for scg in cluster_groups:
             tag = self.get_tag_from_sg(scg.name)
             try:
                 cl = self.get_cluster(tag, group=scg, load_plugins=False,
-                                      load_volumes=False, require_keys=False)
+                                      load_volumes=False, require_keys=False,
+                                      snapshot=snapshot[scg.id])
             except exception.IncompatibleCluster as e:
+                cl = e
+            clusters.append((scg, tag, cl))
+        prober = None
+        if show_ssh_status:
+            nodes = []
+            for scg, tag, cl in clusters:
+                if isinstance(cl, Cluster):
+                    nodes.extend(cl.nodes)
+            prober = SSHProber(nodes, concurrency=ssh_concurrency,
+                               timeout=ssh_timeout, port_only=ssh_port_only)
+        for scg, tag, cl in clusters:
+            if isinstance(cl, exception.IncompatibleCluster):
                 sep = '*' * 60
-                log.error('\n'.join([sep, e.msg, sep]),
+                log.error('\n'.join([sep, cl.msg, sep]),
                           extra=dict(__textwrap__=True))
                 print
                 continue
@@ -379,7 +459,7 @@ class ClusterManager(managers.Manager):
                         nodeline += ' (spot %s)' % node.spot_id
                     if show_ssh_status:
                         ssh_status = {True: 'Up', False: 'Down'}
-                        nodeline += ' (SSH: %s)' % ssh_status[node.is_up()]
+                        nodeline += ' (SSH: %s)' % ssh_status[prober.get(node)]
                     print nodeline
                 print 'Total nodes: %d' % len(nodes)
             else:
@@ -436,7 +516,9 @@ class Cluster(object):
                  config_on_master=False,
                  dns_suffix=None,
                  node_instance_array=[],
-                 impaired_threshold_sec=120):
+                 impaired_threshold_sec=120,
+                 plugin_concurrency=1,
+                 persistent_ssh=False):
         # update class vars with given vars
         _vars = locals().copy()
         for k in ['cluster_group', 'ec2_conn', 'node_image_id',
@@ -463,6 +545,8 @@ class Cluster(object):
         self.force_spot_master = force_spot_master
         self.disable_cloudinit = disable_cloudinit
         self.plugins_order = plugins_order
+        self.plugin_concurrency = plugin_concurrency
+        self.persistent_ssh = persistent_ssh
         self.dns_suffix = dns_suffix and cluster_tag
         if node_instance_array:
             try:
@@ -480,6 +564,7 @@ class Cluster(object):
         self._zone = None
         self._master = None
         self._nodes = []
+        self._node_index = None
         self._pool = None
         self._progress_bar = None
         self.__default_plugin = None
@@ -488,6 +573,7 @@ class Cluster(object):
         self._subnet_zones_mapping = None
         self._impaired_nodes = {}
         self._impaired_threshold_sec = impaired_threshold_sec
+        self._snapshot = None
 
     def __repr__(self):
         return '<Cluster: %s (%s-node)>' % (self.cluster_tag,
@@ -661,7 +747,9 @@ class Cluster(object):
         """
         Load the original settings used to launch this cluster into this
         Cluster object. Settings are loaded from cluster group tags and the
-        master node's user data.
+        master node's user data. Both are cached locally (see ReceiptCache)
+        until the cluster group's tags or the master node change. The config
+        saved on the master (if any) is always read from the master.
         """
         try:
             tags = self.cluster_group.tags
@@ -672,26 +760,50 @@ class Cluster(object):
                 msg = user_msgs.version_mismatch % d
                 sep = '*' * 60
                 log.warn('\n'.join([sep, msg, sep]), extra={'__textwrap__': 1})
-            self.update(self._get_settings_from_tags())
+            cache = receiptcache.ReceiptCache()
+            master_id = receipt = None
+            if cache.has(self.cluster_tag, self.cluster_group):
+                master_id = self._get_master_id()
+                if master_id:
+                    receipt = cache.get(self.cluster_tag, self.cluster_group,
+                                        master_id)
+            if receipt is None:
+                receipt = {}
+            else:
+                log.debug("Using cached receipt for %s" % self.cluster_tag)
+            cached_keys = set(receipt.keys())
+            if 'settings' not in receipt:
+                receipt['settings'] = self._get_settings_from_tags()
+            self.update(copy.deepcopy(receipt['settings']))
             if self.config_on_master:
                 self._load_config_from_master()
-            if not (load_plugins or load_volumes):
-                return True
-            try:
-                master = self.master_node
-            except exception.MasterDoesNotExist:
-                unfulfilled_spots = [sr for sr in self.spot_requests if not
-                                     sr.instance_id]
-                if unfulfilled_spots:
-                    self.wait_for_active_spots()
+            if load_plugins or load_volumes:
+                try:
                     master = self.master_node
-                else:
-                    raise
-            if load_plugins and self.plugins is None:
-                self.plugins = self.load_plugins(
-                    master.get_plugins(self.plugins_order))
-            if load_volumes:
-                self.volumes = master.get_volumes()
+                except exception.MasterDoesNotExist:
+                    unfulfilled_spots = [sr for sr in self.spot_requests
+                                         if not sr.instance_id]
+                    if unfulfilled_spots:
+                        self.wait_for_active_spots()
+                        master = self.master_node
+                    else:
+                        raise
+                if load_plugins and self.plugins is None:
+                    if 'plugins' not in receipt:
+                        receipt['plugins'] = \
+                            master.get_plugins_full_metadata(
+                                self.plugins_order)
+                    self.plugins = self.load_plugins(
+                        master.get_plugins(self.plugins_order,
+                                           receipt['plugins']))
+                if load_volumes:
+                    if 'volumes' not in receipt:
+                        receipt['volumes'] = master.get_volumes()
+                    self.volumes = copy.deepcopy(receipt['volumes'])
+                master_id = master.id
+            if master_id and set(receipt.keys()) != cached_keys:
+                cache.put(self.cluster_tag, self.cluster_group, master_id,
+                          receipt)
         except exception.PluginError:
             log.error("An error occurred while loading plugins: ",
                       exc_info=True)
@@ -703,6 +815,19 @@ class Cluster(object):
             raise exception.IncompatibleCluster(self.cluster_group)
         return True
 
+    def load_snapshot(self, instances, spot_requests):
+        """
+        Serve this cluster's nodes and spot requests from a snapshot of its
+        instances and spot requests instead of querying EC2 each time
+        """
+        self._snapshot = (instances, spot_requests)
+
+    def _get_master_id(self):
+        try:
+            return self.master_node.id
+        except exception.MasterDoesNotExist:
+            return None
+
     def __getstate__(self):
         cfg = {}
         exclude = ['key_location', 'plugins']
@@ -855,6 +980,8 @@ class Cluster(object):
         json.dump(settings, config, indent=4, separators=(',', ': '),
                   sort_keys=True)
         config.close()
+        receiptcache.ReceiptCache().invalidate(self.cluster_tag,
+                                               self.cluster_group)
 
     def _load_config_from_master(self):
         """
@@ -895,10 +1022,13 @@ class Cluster(object):
 
     @property
     def nodes(self):
-        states = ['pending', 'running']
-        filters = {'instance-state-name': states,
-                   'instance.group-name': self._security_group}
-        nodes = self.ec2.get_all_instances(filters=filters)
+        if self._snapshot:
+            nodes = self._snapshot[0]
+        else:
+            states = ['pending', 'running']
+            filters = {'instance-state-name': states,
+                       'instance.group-name': self._security_group}
+            nodes = self.ec2.get_all_instances(filters=filters)
 
         def filter_fct(n):
             if self._security_group in [g.name for g in n.groups]:
@@ -932,6 +1062,7 @@ class Cluster(object):
         # update node cache with latest instance data from EC2
         existing_nodes = dict([(n.id, n) for n in self._nodes])
         log.debug('existing nodes: %s' % existing_nodes)
+        new_nodes = []
         for node in nodes:
             if node.id in existing_nodes:
                 log.debug('updating existing node %s in self._nodes' % node.id)
@@ -940,16 +1071,35 @@ class Cluster(object):
                 enode.instance = node
             else:
                 log.debug('adding node %s to self._nodes list' % node.id)
-                n = Node(node, self.key_location)
-                if n.is_master():
-                    self._master = n
-                    self._nodes.insert(0, n)
-                else:
-                    self._nodes.append(n)
+                new_nodes.append(Node(node, self.key_location,
+                                      persistent_ssh=self.persistent_ssh))
+        self._fetch_spot_requests(new_nodes)
+        for n in new_nodes:
+            if n.is_master():
+                self._master = n
+                self._nodes.insert(0, n)
+            else:
+                self._nodes.append(n)
         self._nodes.sort(key=lambda n: n.alias)
+        self._node_index = None
         log.debug('returning self._nodes = %s' % self._nodes)
         return self._nodes
 
+    def _fetch_spot_requests(self, nodes):
+        """
+        Fetch the parent spot requests of all untagged spot nodes with a
+        single request. Spot instances always have an ami_launch_index of 0
+        so their alias is resolved from their spot request's tags.
+        """
+        nodes = [n for n in nodes if n.spot_id and not n.tags.get('alias')]
+        if not nodes:
+            return
+        filters = {'spot-instance-request-id': [n.spot_id for n in nodes]}
+        spots = self.ec2.get_all_spot_requests(filters=filters)
+        spots = dict([(s.id, s) for s in spots])
+        for n in nodes:
+            n.spot_request = spots.get(n.spot_id)
+
     def get_nodes_or_raise(self, nodes=None):
         _nodes = self.nodes
         if not _nodes:
@@ -961,6 +1111,53 @@ class Cluster(object):
             _nodes = filter(lambda n: n.id in nodes_ids, _nodes)
         return _nodes
 
+    def refresh_nodes(self, nodes, chunk_size=200):
+        """
+        Refresh the instance data of many nodes at once using one
+        DescribeInstances call per chunk_size nodes rather than one call per
+        node (see Node.update). Each node's instance is updated in place and
+        nodes missing from the response are left untouched.
+        """
+        nodes = list(nodes)
+        instances = {}
+        for ids in utils.chunk_list([n.id for n in nodes], chunk_size):
+            for instance in self.ec2.get_all_instances(
+                    filters={'instance-id': ids}):
+                instances[instance.id] = instance
+        for node in nodes:
+            if node.id in instances:
+                node.instance = instances[node.id]
+            else:
+                log.debug("Failed to refresh instance-id %s" % node.id)
+        self._node_index = None
+        return nodes
+
+    @staticmethod
+    def _get_node_identifiers(node):
+        return [node.private_dns_name, node.public_dns_name,
+                node.private_ip_address, node.ip_address, node.dns_name,
+                node.spot_id, node.id, node.alias]
+
+    def _get_node_index(self, nodes, rebuild=False):
+        """
+        Returns a dict mapping every unique instance attribute of the given
+        nodes to its node. The index is cached for the given node list until
+        the list changes size or the nodes are refreshed (see nodes and
+        refresh_nodes). When several nodes share an identifier the first one
+        in the list wins.
+        """
+        if not rebuild and self._node_index:
+            cached_nodes, size, index = self._node_index
+            if cached_nodes is nodes and size == len(nodes):
+                return index
+        index = {}
+        for node in reversed(nodes):
+            for attr in self._get_node_identifiers(node):
+                if attr:
+                    index[attr] = node
+        self._node_index = (nodes, len(nodes), index)
+        return index
+
     def get_node(self, identifier, nodes=None):
         """
         Returns a node if the identifier specified matches any unique instance
@@ -968,24 +1165,14 @@ class Cluster(object):
         public ip, etc.)
         """
         nodes = nodes or self.nodes
-        for node in self.nodes:
-            if node.alias == identifier:
-                return node
-            if node.id == identifier:
-                return node
-            if node.spot_id == identifier:
-                return node
-            if node.dns_name == identifier:
-                return node
-            if node.ip_address == identifier:
-                return node
-            if node.private_ip_address == identifier:
-                return node
-            if node.public_dns_name == identifier:
-                return node
-            if node.private_dns_name == identifier:
-                return node
-        raise exception.InstanceDoesNotExist(identifier, label='node')
+        node = self._get_node_index(nodes).get(identifier)
+        if node is None or identifier not in self._get_node_identifiers(node):
+            # a node's instance data or alias may have changed since the
+            # index was built
+            node = self._get_node_index(nodes, rebuild=True).get(identifier)
+        if node is None:
+            raise exception.InstanceDoesNotExist(identifier, label='node')
+        return node
 
     def get_nodes(self, identifiers, nodes=None):
         """
@@ -993,13 +1180,18 @@ class Cluster(object):
         nodes.
         """
         nodes = nodes or self.nodes
+        index = self._get_node_index(nodes)
         node_list = []
+        node_ids = set()
         for i in identifiers:
-            n = self.get_node(i, nodes=nodes)
-            if n in node_list:
+            n = index.get(i)
+            if n is None or i not in self._get_node_identifiers(n):
+                n = self.get_node(i, nodes=nodes)
+                index = self._get_node_index(nodes)
+            if n.id in node_ids:
                 continue
-            else:
-                node_list.append(n)
+            node_ids.add(n.id)
+            node_list.append(n)
         return node_list
 
     def get_node_by_dns_name(self, dns_name, nodes=None):
@@ -1045,6 +1237,8 @@ class Cluster(object):
 
     @property
     def spot_requests(self):
+        if self._snapshot:
+            return self._snapshot[1][:]
         group_id = self.cluster_group.id
         states = ['active', 'open']
         filters = {'state': states}
@@ -1098,9 +1292,14 @@ class Cluster(object):
             zones_filter = [s_net.availability_zone
                             for s_net in self.subnets_mapping.values()]
 
+        vpc = self.vpc_id is not None
+        instance_types = set([i['instance_type'] for i in
+                              self.node_instance_array])
+        prices = self.ec2.get_spot_prices(instance_types, zones_filter,
+                                          vpc=vpc)
         for i in self.node_instance_array:
             zone, price = self.ec2.get_spot_cheapest_zone(
-                i['instance_type'], zones_filter, vpc=self.vpc_id is not None)
+                i['instance_type'], zones_filter, vpc=vpc, prices=prices)
             log.debug("%s %s: %f", i['instance_type'], zone, price)
             if selection is None or (
                     price < i['spot_bid'] and
@@ -1178,7 +1377,7 @@ class Cluster(object):
             zone = getattr(self.zone, 'name', None)
 
         image_id = image_id or self.node_image_id
-        count = len(aliases) if not spot_bid else 1
+        count = len(aliases)
         user_data = self._get_cluster_userdata(aliases)
         kwargs = dict(price=spot_bid, instance_type=instance_type,
                       min_count=count, max_count=count, count=count,
@@ -1207,18 +1406,30 @@ class Cluster(object):
             kwargs.update(security_groups=[cluster_sg])
         resvs = []
         if spot_bid:
-            security_group_id = self.cluster_group.id
-            for alias in aliases:
-                if not self.subnet_ids:
-                    kwargs['security_group_ids'] = [security_group_id]
-                kwargs['user_data'] = self._get_cluster_userdata([alias])
-                resvs.extend(self.ec2.request_instances(image_id, **kwargs))
+            if not self.subnet_ids:
+                kwargs['security_group_ids'] = [self.cluster_group.id]
+            resvs.extend(self.ec2.request_instances(image_id, **kwargs))
+            try:
+                self._tag_spot_requests(resvs, aliases)
+            except Exception:
+                log.error("Failed to tag spot requests with their aliases, "
+                          "cancelling them")
+                self.ec2.cancel_spot_requests([s.id for s in resvs])
+                raise
         else:
             resvs.append(self.ec2.request_instances(image_id, **kwargs))
         for resv in resvs:
             log.info(str(resv), extra=dict(__raw__=True))
         return resvs
 
+    def _tag_spot_requests(self, spots, aliases):
+        """
+        Tag each spot request of a batched request with the alias of the
+        node it will launch (see _fetch_spot_requests)
+        """
+        self.pool.map(lambda s, a: self.ec2.create_tags([s], {'alias': a}),
+                      spots, aliases)
+
     @classmethod
     def get_free_ids_among_nodes(cls, count, nodes):
         result = []
@@ -1261,12 +1472,14 @@ class Cluster(object):
     def add_nodes(self, num_nodes, aliases=None, image_id=None,
                   instance_type=None, zone=None, placement_group=None,
                   spot_bid=None, no_create=False, reboot_interval=10,
-                  n_reboot_restart=False):
+                  n_reboot_restart=False, timeline_file=None):
         """
         Add new nodes to this cluster
 
         aliases - list of aliases to assign to new nodes (len must equal
         num_nodes)
+        timeline_file - optional path of a JSON file to write the per-node
+        timeline of the add stages to
         """
         running_pending = self._nodes_in_states(['pending', 'running'])
         aliases = aliases or []
@@ -1281,9 +1494,8 @@ class Cluster(object):
         if no_create:
             self.wait_for_cluster(msg="Waiting for node(s) to come up...")
             log.debug("Adding node(s): %s" % aliases)
-            for alias in aliases:
-                node = self.get_node(alias)
-                self.run_plugins(method_name="on_add_node", node=node)
+            nodes = [self.get_node(alias) for alias in aliases]
+            self.run_plugins(method_name="on_add_nodes", node=nodes)
         else:
             if self.subnet_ids:
                 subnet = None
@@ -1309,11 +1521,13 @@ class Cluster(object):
             if spot_bid or self.spot_bid:
                 streaming_add(self, spots=resp,
                               reboot_interval=reboot_interval,
-                              n_reboot_restart=n_reboot_restart)
+                              n_reboot_restart=n_reboot_restart,
+                              timeline_file=timeline_file)
             else:
                 streaming_add(self, instances=resp[0].instances,
                               reboot_interval=reboot_interval,
-                              n_reboot_restart=n_reboot_restart)
+                              n_reboot_restart=n_reboot_restart,
+                              timeline_file=timeline_file)
 
         if all([not no_create, spot_bid, reboot_interval, n_reboot_restart]):
             # this will recreate the spot instances that might have died in
@@ -1372,16 +1586,55 @@ class Cluster(object):
                 if node.is_master():
                     raise exception.InvalidOperation(
                         "cannot remove master node")
-        for node in nodes:
+        try:
+            self.run_plugins(method_name="on_remove_nodes", node=nodes,
+                             reverse=True)
+        except:
+            # retry one node at a time so that a single failing node does
+            # not prevent the others from being cleaned up
+            if len(nodes) > 1:
+                log.error("Failed to remove nodes together, removing them "
+                          "one at a time", exc_info=True)
+                for node in nodes:
+                    try:
+                        self.run_plugins(method_name="on_remove_node",
+                                         node=node, reverse=True)
+                    except:
+                        # will still allow node termination
+                        pass
+        if terminate:
+            self.terminate_nodes(nodes)
+
+    def terminate_nodes(self, nodes):
+        """
+        Cancel the spot requests of and terminate all nodes with one
+        request each
+        """
+        spot_ids = [n.spot_id for n in nodes if n.spot_id]
+        if spot_ids:
+            log.info("Canceling spot request(s) %s" % ', '.join(spot_ids))
             try:
-                self.run_plugins(method_name="on_remove_node",
-                                 node=node, reverse=True)
-            except:
-                # will still allow node termination
-                pass
-            if not terminate:
-                continue
-            node.terminate()
+                self.ec2.cancel_spot_requests(spot_ids)
+            except Exception:
+                log.error("Failed to cancel spot requests %s" % spot_ids,
+                          exc_info=True)
+        for node in nodes:
+            log.info("Terminating node: %s (%s)" % (node.alias, node.id))
+        try:
+            self.ec2.terminate_instances([n.id for n in nodes])
+        except EC2ResponseError as e:
+            if len(nodes) == 1:
+                raise
+            # the request fails as a whole if any instance id is invalid
+            # (e.g. already terminated) so terminate the nodes one by one
+            log.warn("Failed to terminate nodes at once (%s), terminating "
+                     "them one at a time" % e.error_code)
+            for node in nodes:
+                try:
+                    self.ec2.terminate_instances([node.id])
+                except EC2ResponseError as e:
+                    log.error("Failed to terminate node %s (%s): %s" %
+                              (node.alias, node.id, e.error_code))
 
     def _get_launch_map(self, reverse=False):
         """
@@ -1505,10 +1758,10 @@ class Cluster(object):
 
     def _create_spot_cluster(self):
         """
-        Launches cluster using spot instances for all worker nodes. This method
-        makes a single spot request for each node in the cluster since spot
-        instances *always* have an ami_launch_index of 0. This is needed in
-        order to correctly assign aliases to nodes.
+        Launches cluster using spot instances for all worker nodes. Worker
+        nodes with the same type/ami are requested in a single batched spot
+        request. Spot instances *always* have an ami_launch_index of 0 so
+        each spot request is tagged with the alias of its node.
         """
         master_alias = self._make_alias(master=True)
         (mtype, mimage) = self._get_type_and_image_id(master_alias)
@@ -1530,14 +1783,17 @@ class Cluster(object):
             # Make sure nodes are in same zone as master
             zone = master_response.instances[0].placement
             insts.extend(master_response.instances)
-        for id in range(1, self.cluster_size):
-            alias = self._make_alias(id)
-            (ntype, nimage) = self._get_type_and_image_id(alias)
-            log.info("Launching %s (ami: %s, type: %s)" %
-                     (alias, nimage, ntype))
-            spot_req = self.create_node(alias, image_id=nimage,
-                                        instance_type=ntype, zone=zone)
-            spot_reqs.append(spot_req)
+        lmap = self._get_launch_map()
+        for (ntype, nimage), aliases in lmap.iteritems():
+            aliases = [a for a in aliases if a != master_alias]
+            if not aliases:
+                continue
+            for alias in aliases:
+                log.info("Launching %s (ami: %s, type: %s)" %
+                         (alias, nimage, ntype))
+            spot_reqs.extend(self.create_nodes(aliases, image_id=nimage,
+                                               instance_type=ntype,
+                                               zone=zone))
         self.ec2.wait_for_propagation(instances=insts, spot_requests=spot_reqs)
 
     def is_spot_cluster(self):
@@ -1638,7 +1894,7 @@ class Cluster(object):
         if not nodes:
             return False
         for node in nodes:
-            if not node.is_up():
+            if not node.is_up(update=False):
                 return False
         return True
 
@@ -1678,6 +1934,7 @@ class Cluster(object):
         """
         spots = spots or self.spot_requests
         open_spots = [spot for spot in spots if spot.state == "open"]
+        waiter = self.ec2.get_propagation_waiter()
         if open_spots:
             pbar = self.progress_bar.reset()
             log.info('Waiting for open spot requests to become active...')
@@ -1686,14 +1943,18 @@ class Cluster(object):
             while not pbar.finished:
                 active_spots = [s for s in spots if s.state == "active" and
                                 s.instance_id]
+                # start checking the instances of active spots for
+                # propagation while waiting on the remaining spots
+                waiter.add('instance', [s.instance_id for s in active_spots])
+                waiter.check()
                 pbar.maxval = len(spots)
                 pbar.update(len(active_spots))
                 if not pbar.finished:
                     time.sleep(self.refresh_interval)
                     spots = self.get_spot_requests_or_raise(spots)
             pbar.reset()
-        self.ec2.wait_for_propagation(
-            instances=[s.instance_id for s in spots])
+        waiter.add('instance', [s.instance_id for s in spots])
+        waiter.wait()
 
     def wait_for_running_instances(self, nodes=None,
                                    kill_pending_after_mins=15):
@@ -1731,13 +1992,18 @@ class Cluster(object):
         """
         log.info("Waiting for SSH to come up on all nodes...")
         nodes = nodes or self.get_nodes_or_raise()
-        params = {"interval": self.refresh_interval,
-                  "reboot_interval": reboot_interval,
-                  "n_reboot_restart": n_reboot_restart}
-        self.pool.map(
-            lambda n: n.wait(**params),
-            nodes,
-            jobid_fn=lambda n: n.alias)
+        nrms = dict([(n.id, NodeRecoveryManager(n, reboot_interval,
+                                                n_reboot_restart))
+                     for n in nodes])
+        while True:
+            self.refresh_nodes(nodes)
+            ssh_up = self.pool.map(lambda n: (n, n.is_up(update=False)),
+                                   nodes, jobid_fn=lambda n: n.alias)
+            nodes = [n for n, up in ssh_up if not up]
+            nodes = filter(lambda n: nrms[n.id].check(), nodes)
+            if not nodes:
+                break
+            time.sleep(self.refresh_interval)
 
     @print_timing("Waiting for cluster to come up")
     def wait_for_cluster(self, msg="Waiting for cluster to come up...",
@@ -1903,11 +2169,12 @@ class Cluster(object):
                 self.ec2.delete_group(pg)
         sg = self.ec2.get_group_or_none(self._security_group)
         if sg:
+            receiptcache.ReceiptCache().invalidate(self.cluster_tag, sg)
             self.ec2.delete_group(sg)
 
     def start(self, create=True, create_only=False, validate=True,
               validate_only=False, validate_running=False,
-              save_config_on_master=False):
+              save_config_on_master=False, pipelined=False):
         """
         Creates and configures a cluster from this cluster template's settings.
 
@@ -1922,6 +2189,8 @@ class Cluster(object):
                         configure cluster
         validate_running - whether or not to validate the existing instances
                            being used against this cluster's settings
+        pipelined - configure the master and then each worker as soon as it
+                    comes up instead of waiting for all nodes to come up
         """
         if validate:
             validator = self.validator
@@ -1939,11 +2208,12 @@ class Cluster(object):
         else:
             log.warn("SKIPPING VALIDATION - USE AT YOUR OWN RISK")
         return self._start(create=create, create_only=create_only,
-                           save_config_on_master=save_config_on_master)
+                           save_config_on_master=save_config_on_master,
+                           pipelined=pipelined)
 
     @print_timing("Starting cluster")
     def _start(self, create=True, create_only=False,
-               save_config_on_master=False):
+               save_config_on_master=False, pipelined=False):
         """
         Create and configure a cluster from this cluster template's settings
         (Does not attempt to validate before running)
@@ -1963,17 +2233,57 @@ class Cluster(object):
                 node.start()
         if create_only:
             return
-        self.setup_cluster(save_config_on_master)
+        self.setup_cluster(save_config_on_master, pipelined=pipelined)
 
-    def setup_cluster(self, save_config_on_master):
+    def setup_cluster(self, save_config_on_master, pipelined=False):
         """
         Waits for all nodes to come up and then runs the default
         StarCluster setup routines followed by any additional plugin setup
-        routines
+        routines. Passing pipelined=True configures each node as soon as it
+        comes up instead (see _setup_cluster_pipelined)
         """
+        if pipelined:
+            self._setup_cluster_pipelined(save_config_on_master)
+            return
         self.wait_for_cluster()
         self._setup_cluster(save_config_on_master)
 
+    def setup_master(self, save_config_on_master):
+        """
+        Runs the default StarCluster and queue setup routines on the master
+        node only
+        """
+        log.info("The master node is %s" % self.master_node.dns_name)
+        log.info("Configuring master node...")
+        if save_config_on_master:
+            self.save_config_on_master()
+        if self.volumes:
+            self.attach_volumes_to_master()
+        self.run_plugins(nodes=[self.master_node], user_plugins=False)
+
+    @print_timing("Configuring cluster")
+    def _setup_cluster_pipelined(self, save_config_on_master):
+        """
+        Configures the master as soon as it is up and then adds each worker
+        to the cluster (the built-in plugins' on_add_nodes) as soon as it is
+        up. User plugins are run once all nodes have been added.
+        """
+        interval = self.refresh_interval
+        log.info("Configuring cluster as nodes come up (updating every "
+                 "%ds)" % interval)
+        spots = self.spot_requests
+        spot_ids = [s.id for s in spots]
+        instances = [n for n in self.nodes if n.spot_id not in spot_ids]
+        sna = StreamingClusterStart(
+            self, spots, instances, reboot_interval=10,
+            n_reboot_restart=False,
+            save_config_on_master=save_config_on_master)
+        sna.run()
+        if not sna.master_ready:
+            raise exception.MasterDoesNotExist()
+        if self.plugins:
+            self.run_plugins(plugins=self.plugins, builtin_plugins=False)
+
     @print_timing("Configuring cluster")
     def _setup_cluster(self, save_config_on_master):
         """
@@ -1989,25 +2299,92 @@ class Cluster(object):
         self.run_plugins()
 
     def run_plugins(self, plugins=None, method_name="run", node=None,
-                    reverse=False, nodes=None):
+                    reverse=False, nodes=None, builtin_plugins=True,
+                    user_plugins=True):
         """
         Run all plugins specified in this Cluster object's self.plugins list
         Uses plugins list instead of self.plugins if specified.
 
         plugins must be a tuple: the first element is the plugin's name, the
         second element is the plugin object (a subclass of ClusterSetup)
+
+        Plugins run in the order given by their declared dependencies (see
+        clustersetup.get_plugin_deps), in reverse if reverse is True. Up to
+        self.plugin_concurrency plugins whose dependencies have completed
+        run at the same time.
+
+        builtin_plugins/user_plugins - set to False to skip the built-in
+        plugins (DefaultClusterSetup and SGE) or the user plugins
         """
-        plugs = [self._default_plugin]
+        builtins = [self._default_plugin]
         if not self.disable_queue:
-            plugs.append(self._sge_plugin)
+            builtins.append(self._sge_plugin)
+        plugs = builtins[:] if builtin_plugins else []
         _plugs = plugins or self.plugins
-        if _plugs:
+        if _plugs and user_plugins:
             plugs += _plugs[:]
-        if reverse:
-            plugs.reverse()
-        for plug in plugs:
-            self.run_plugin(plug, method_name=method_name, node=node,
-                            nodes=nodes)
+        satisfied = []
+        if not builtin_plugins:
+            # built-in plugins are assumed to have run already
+            for plug in builtins:
+                satisfied.extend(clustersetup._get_plugin_names(plug))
+        num_builtin = len(builtins) if builtin_plugins else 0
+        deps = clustersetup.get_plugin_deps(plugs, num_builtin=num_builtin,
+                                            satisfied=satisfied)
+        order, deps = clustersetup.get_plugin_order(plugs, deps,
+                                                    reverse=reverse)
+        if self.plugin_concurrency <= 1:
+            for i in order:
+                self.run_plugin(plugs[i], method_name=method_name, node=node,
+                                nodes=nodes)
+            return
+        # resolve nodes once rather than in each plugin thread
+        nodes = nodes or self.nodes
+        self._run_plugins_concurrently(plugs, order, deps,
+                                       method_name=method_name, node=node,
+                                       nodes=nodes)
+
+    def _run_plugins_concurrently(self, plugs, order, deps, **kwargs):
+        """
+        Runs plugs (in order) in separate threads as soon as all plugins
+        in their deps have completed with at most self.plugin_concurrency
+        plugins running at once. No new plugins are started once a plugin
+        fails and the first failure is re-raised after the running plugins
+        complete.
+        """
+        finished = Queue.Queue()
+
+        def run(i):
+            try:
+                self.run_plugin(plugs[i], **kwargs)
+                finished.put((i, None))
+            except BaseException:
+                finished.put((i, sys.exc_info()))
+        pending = list(order)
+        running = set()
+        done = set()
+        error = None
+        while running or (pending and not error):
+            for i in pending[:]:
+                if error or len(running) >= self.plugin_concurrency:
+                    break
+                if deps[i] <= done:
+                    pending.remove(i)
+                    running.add(i)
+                    thread = threading.Thread(target=run, args=(i,))
+                    thread.daemon = True
+                    thread.start()
+            try:
+                # wait with a timeout so that KeyboardInterrupt is handled
+                i, exc_info = finished.get(True, 1)
+            except Queue.Empty:
+                continue
+            running.remove(i)
+            done.add(i)
+            if exc_info and not error:
+                error = exc_info
+        if error:
+            raise error[0], error[1], error[2]
 
     def run_plugin(self, plugin, name='', method_name='run', node=None,
                    nodes=None, args=None):
@@ -2018,14 +2395,18 @@ class Cluster(object):
         name - a user-friendly label for the plugin
         method_name - the method to run within the plugin (default: "run")
         node - optional node to pass as first argument to plugin method (used
-        for on_add_node/on_remove_node)
+        for on_add_node/on_remove_node, a list of nodes for
+        on_add_nodes/on_remove_nodes)
         """
         if args is None:
             args = []
         plugin_name = name or getattr(plugin, '__name__',
                                       utils.get_fq_class_name(plugin))
         try:
-            func = getattr(plugin, method_name, None)
+            if method_name in ['on_add_nodes', 'on_remove_nodes']:
+                func = clustersetup.get_batch_hook(plugin, method_name)
+            else:
+                func = getattr(plugin, method_name, None)
             if not func:
                 log.warn("Plugin %s has no %s method...skipping" %
                          (plugin_name, method_name))
@@ -2056,6 +2437,92 @@ class Cluster(object):
                                       forward_agent=forward_agent,
                                       pseudo_tty=pseudo_tty)
 
+    def execute_on_nodes(self, command, nodes=None, concurrency=20,
+                         timeout=None, straggler_interval=30, **kwargs):
+        """
+        Executes command on nodes (defaults to all running nodes) using each
+        node's SSHClient.execute with at most concurrency nodes at a time
+        and yields a (node, exit_status, output) tuple as soon as each node
+        finishes. output is the list of output lines.
+
+        A failure on one node does not abort the others: if the command
+        could not be run on a node exit_status is None and output contains
+        the error. Nodes still running every straggler_interval seconds are
+        logged. No more nodes are started once the generator is closed or
+        timeout seconds have passed. In the latter case nodes still running
+        and nodes never started are yielded with an exit_status of None and a
+        'timed out' or 'not started' message respectively. Extra kwargs are
+        passed to SSHClient.execute.
+        """
+        if nodes is None:
+            nodes = self.running_nodes
+        kwargs.setdefault('log_output', False)
+        todo = Queue.Queue()
+        finished = Queue.Queue()
+        for node in nodes:
+            todo.put(node)
+
+        def work():
+            while True:
+                try:
+                    node = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    output = node.ssh.execute(command, **kwargs)
+                    finished.put((node, 0, output))
+                except exception.RemoteCommandFailed as e:
+                    output = e.output.splitlines() if e.output else []
+                    finished.put((node, e.exit_status, output))
+                except Exception as e:
+                    log.debug("failed to run '%s' on %s" %
+                              (command, node.alias), exc_info=True)
+                    finished.put((node, None, [str(e) or repr(e)]))
+        for i in xrange(min(concurrency, len(nodes))):
+            worker = threading.Thread(target=work)
+            worker.daemon = True
+            worker.start()
+
+        def drain():
+            # keep the workers from starting any more nodes
+            not_started = []
+            while True:
+                try:
+                    not_started.append(todo.get_nowait())
+                except Queue.Empty:
+                    return not_started
+        running = dict([(node.id, node) for node in nodes])
+        start = last_report = time.time()
+        try:
+            while running:
+                now = time.time()
+                if timeout is not None and now - start >= timeout:
+                    not_started = drain()
+                    for node in not_started:
+                        running.pop(node.id, None)
+                    for node in sorted(running.values(),
+                                       key=lambda n: n.alias):
+                        yield (node, None,
+                               ["timed out after %d seconds" % timeout])
+                    for node in sorted(not_started, key=lambda n: n.alias):
+                        yield (node, None, ["not started after %d seconds" %
+                                            timeout])
+                    return
+                if now - last_report >= straggler_interval:
+                    last_report = now
+                    log.info("Waiting on %d node(s): %s" %
+                             (len(running), ', '.join(
+                                 sorted([n.alias for n in running.values()]))))
+                try:
+                    # wait with a timeout so that KeyboardInterrupt is handled
+                    node, exit_status, output = finished.get(True, 1)
+                except Queue.Empty:
+                    continue
+                running.pop(node.id, None)
+                yield node, exit_status, output
+        finally:
+            drain()
+
     def ssh_to_node(self, alias, user='root', command=None, forward_x11=False,
                     forward_agent=False, pseudo_tty=False):
         node = self.get_node(alias)
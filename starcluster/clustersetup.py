@@ -19,6 +19,7 @@
 clustersetup.py
 """
 import os
+import inspect
 import posixpath
 import datetime
 
@@ -29,13 +30,132 @@ from starcluster.logger import log
 from starcluster import exception
 
 
+def get_batch_hook(plugin, method_name):
+    """
+    Returns plugin's batch hook method_name (on_add_nodes or
+    on_remove_nodes). Plugins that override the matching per-node hook
+    (on_add_node or on_remove_node) further down their class hierarchy than
+    the batch hook (or that do not define the batch hook at all) get a
+    function calling their per-node hook for each node instead. Returns
+    None if the plugin defines neither hook.
+    """
+    node_method_name = method_name[:-1]
+    for klass in inspect.getmro(plugin.__class__):
+        if method_name in vars(klass):
+            return getattr(plugin, method_name)
+        if node_method_name in vars(klass):
+            break
+    node_method = getattr(plugin, node_method_name, None)
+    if not node_method:
+        return None
+
+    def batch_hook(batch_nodes, nodes, master, user, user_shell, volumes):
+        for node in batch_nodes:
+            node_method(node, nodes, master, user, user_shell, volumes)
+    return batch_hook
+
+
+def _get_plugin_names(plugin):
+    names = [plugin.__class__.__name__]
+    name = getattr(plugin, '__name__', None)
+    if name and name not in names:
+        names.append(name)
+    return names
+
+
+def get_plugin_deps(plugins, num_builtin=0, satisfied=None):
+    """
+    Returns a list containing, for each plugin in plugins, the set of
+    indices of the plugins that must finish before it can run.
+
+    The first num_builtin plugins (DefaultClusterSetup and SGE) run in order
+    before any other plugin. Plugins that declare neither requires nor
+    after keep running in order after all plugins listed before them except
+    those that explicitly declare a dependency on them. Plugins that do
+    declare dependencies only wait for those (and the built-in plugins).
+    Plugins are referred to by plugin section name or class name. Required
+    plugins whose names are in satisfied (eg built-in plugins that already
+    ran) are not required to be in plugins.
+    """
+    satisfied = satisfied or []
+    indices = {}
+    for i, plug in enumerate(plugins):
+        for name in _get_plugin_names(plug):
+            indices.setdefault(name, []).append(i)
+    declared = []
+    for i, plug in enumerate(plugins):
+        deps = set()
+        for name in getattr(plug, 'requires', None) or []:
+            if name not in indices:
+                if name in satisfied:
+                    continue
+                raise exception.PluginError(
+                    "plugin %s requires plugin %s which is not configured" %
+                    (_get_plugin_names(plug)[-1], name))
+            deps.update(indices[name])
+        for name in getattr(plug, 'after', None) or []:
+            deps.update(indices.get(name, []))
+        deps.discard(i)
+        declared.append(deps)
+    all_deps = []
+    for i, plug in enumerate(plugins):
+        if i < num_builtin:
+            deps = set(range(i))
+        elif getattr(plug, 'requires', None) or getattr(plug, 'after', None):
+            deps = declared[i] | set(range(num_builtin))
+        else:
+            deps = set([j for j in range(i) if i not in declared[j]])
+        all_deps.append(deps)
+    return all_deps
+
+
+def get_plugin_order(plugins, deps, reverse=False):
+    """
+    Returns a tuple (order, deps) where order lists the indices of plugins
+    in the order they should run given deps (see get_plugin_deps)
+    preferring earlier plugins. If reverse is True all dependencies are
+    inverted (ie plugins run after the plugins that depend on them)
+    preferring later plugins and the inverted deps are returned. Raises
+    PluginError if the dependencies are circular.
+    """
+    if reverse:
+        deps = [set([j for j in range(len(deps)) if i in deps[j]])
+                for i in range(len(deps))]
+    order = []
+    done = set()
+    pending = range(len(deps))
+    if reverse:
+        pending.reverse()
+    while pending:
+        for i in pending:
+            if deps[i] <= done:
+                break
+        else:
+            names = [_get_plugin_names(plugins[i])[-1] for i in pending]
+            raise exception.PluginError(
+                "circular dependencies between plugins: %s" %
+                ', '.join(names))
+        pending.remove(i)
+        done.add(i)
+        order.append(i)
+    return order, deps
+
+
 class ClusterSetup(object):
     """
     ClusterSetup Interface
 
     This is the base class for all StarCluster plugins. A plugin should
     implement at least one if not all of these methods.
+
+    Plugins can declare the plugins (by section or class name) that must
+    run before them in requires (which must be configured) or after (which
+    are ignored if not configured). Plugins that declare dependencies can
+    run concurrently with other plugins when plugin_concurrency > 1.
     """
+    requires = []
+    after = []
+
     def __init__(self, *args, **kwargs):
         pass
 
@@ -45,6 +165,17 @@ class ClusterSetup(object):
         """
         raise NotImplementedError('on_add_node method not implemented')
 
+    def on_add_nodes(self, new_nodes, nodes, master, user, user_shell,
+                     volumes):
+        """
+        This method gets executed after many nodes have been added to the
+        cluster at once. Defaults to calling on_add_node for each node.
+        Plugins should override it when cluster-wide updates can be done
+        once for all new nodes.
+        """
+        for node in new_nodes:
+            self.on_add_node(node, nodes, master, user, user_shell, volumes)
+
     def on_remove_node(self, node, nodes, master, user, user_shell, volumes):
         """
         This method gets executed before a node is about to be removed from the
@@ -52,6 +183,18 @@ class ClusterSetup(object):
         """
         raise NotImplementedError('on_remove_node method not implemented')
 
+    def on_remove_nodes(self, removed_nodes, nodes, master, user, user_shell,
+                        volumes):
+        """
+        This method gets executed before many nodes are about to be removed
+        from the cluster at once. Defaults to calling on_remove_node for
+        each node. Plugins should override it when cluster-wide updates can
+        be done once for all removed nodes.
+        """
+        for node in removed_nodes:
+            self.on_remove_node(node, nodes, master, user, user_shell,
+                                volumes)
+
     def on_restart(self, nodes, master, user, user_shell, volumes):
         """
         This method gets executed before restart the cluster
@@ -220,19 +363,18 @@ class DefaultClusterSetup(ClusterSetup):
         self.pool.wait(numtasks=len(nodes))
 
     def _setup_scratch_on_node(self, node, users=None):
-        nconn = node.ssh
         users = users or [self._user]
-        for user in users:
-            user_scratch = '/mnt/%s' % user
-            if not nconn.path_exists(user_scratch):
-                nconn.mkdir(user_scratch)
-            nconn.execute('chown -R %(user)s:%(user)s /mnt/%(user)s' %
+        with node.ssh.batch() as batch:
+            for user in users:
+                user_scratch = '/mnt/%s' % user
+                batch.add('mkdir -p %s' % user_scratch)
+                batch.add('chown -R %(user)s:%(user)s /mnt/%(user)s' %
                           {'user': user})
-            scratch = '/scratch'
-            if not nconn.path_exists(scratch):
-                nconn.mkdir(scratch)
-            if not nconn.path_exists(posixpath.join(scratch, user)):
-                nconn.execute('ln -s %s %s' % (user_scratch, scratch))
+                scratch = '/scratch'
+                batch.add('mkdir -p %s' % scratch)
+                batch.add('test -e %s || ln -s %s %s' %
+                          (posixpath.join(scratch, user), user_scratch,
+                           scratch))
 
     def _setup_scratch(self, nodes=None, users=None):
         """ Configure scratch space on all StarCluster nodes """
@@ -387,29 +529,40 @@ class DefaultClusterSetup(ClusterSetup):
         self._setup_passwordless_ssh()
 
     def _remove_from_etc_hosts(self, node):
-        nodes = filter(lambda x: x.id != node.id, self.running_nodes)
+        self._remove_nodes_from_etc_hosts([node])
+
+    def _remove_nodes_from_etc_hosts(self, removed_nodes):
+        removed_ids = [n.id for n in removed_nodes]
+        nodes = filter(lambda x: x.id not in removed_ids, self.running_nodes)
         master = None
 
         for n in nodes:
             if n.is_master():
                 master = n
 
-        master.remove_from_etc_hosts([node])
+        master.remove_from_etc_hosts(removed_nodes)
         master.copy_remote_file_to_nodes('/etc/hosts', nodes)
 
     def _remove_nfs_exports(self, node):
-        self._master.stop_exporting_fs_to_nodes([node])
+        self._remove_nodes_nfs_exports([node])
+
+    def _remove_nodes_nfs_exports(self, removed_nodes):
+        self._master.stop_exporting_fs_to_nodes(removed_nodes)
 
     def _remove_from_known_hosts(self, node):
-        nodes = filter(lambda x: x.id != node.id, self.running_nodes)
+        self._remove_nodes_from_known_hosts([node])
+
+    def _remove_nodes_from_known_hosts(self, removed_nodes):
+        removed_ids = [n.id for n in removed_nodes]
+        nodes = filter(lambda x: x.id not in removed_ids, self.running_nodes)
         master = None
 
         for n in nodes:
             if n.is_master():
                 master = n
 
-        master.remove_from_known_hosts('root', [node])
-        master.remove_from_known_hosts(self._user, [node])
+        master.remove_from_known_hosts('root', removed_nodes)
+        master.remove_from_known_hosts(self._user, removed_nodes)
 
         target = posixpath.join('/root', '.ssh', 'known_hosts')
         master.copy_remote_file_to_nodes(target, nodes)
@@ -422,36 +575,50 @@ class DefaultClusterSetup(ClusterSetup):
             log.warning("Failed to copy file " + target)
 
     def on_remove_node(self, node, nodes, master, user, user_shell, volumes):
+        self.on_remove_nodes([node], nodes, master, user, user_shell,
+                             volumes)
+
+    def on_remove_nodes(self, removed_nodes, nodes, master, user, user_shell,
+                        volumes):
         self._nodes = nodes
         self._master = master
         self._user = user
         self._user_shell = user_shell
         self._volumes = volumes
-        log.info("Removing node %s (%s)..." % (node.alias, node.id))
-        log.info("Removing %s from known_hosts files" % node.alias)
-        self._remove_from_known_hosts(node)
-        log.info("Removing %s from /etc/hosts" % node.alias)
-        self._remove_from_etc_hosts(node)
-        log.info("Removing %s from NFS" % node.alias)
-        self._remove_nfs_exports(node)
+        aliases = ', '.join([n.alias for n in removed_nodes])
+        for node in removed_nodes:
+            log.info("Removing node %s (%s)..." % (node.alias, node.id))
+        log.info("Removing %s from known_hosts files" % aliases)
+        self._remove_nodes_from_known_hosts(removed_nodes)
+        log.info("Removing %s from /etc/hosts" % aliases)
+        self._remove_nodes_from_etc_hosts(removed_nodes)
+        log.info("Removing %s from NFS" % aliases)
+        self._remove_nodes_nfs_exports(removed_nodes)
 
     def _create_user(self, node):
+        self._create_users([node])
+
+    def _create_users(self, nodes):
         user = self._master.getpwnam(self._user)
         uid, gid = user.pw_uid, user.pw_gid
-        self._add_user_to_nodes(uid, gid, nodes=[node])
+        self._add_user_to_nodes(uid, gid, nodes=nodes)
 
     def on_add_node(self, node, nodes, master, user, user_shell, volumes):
+        self.on_add_nodes([node], nodes, master, user, user_shell, volumes)
+
+    def on_add_nodes(self, new_nodes, nodes, master, user, user_shell,
+                     volumes):
         self._nodes = nodes
         self._master = master
         self._user = user
         self._user_shell = user_shell
         self._volumes = volumes
-        self._setup_hostnames(nodes=[node])
+        self._setup_hostnames(nodes=new_nodes)
         self._setup_etc_hosts(nodes)
-        self._setup_nfs(nodes=[node], start_server=False)
-        self._create_user(node)
-        self._setup_scratch(nodes=[node])
-        self._setup_passwordless_ssh(nodes=[node])
+        self._setup_nfs(nodes=new_nodes, start_server=False)
+        self._create_users(new_nodes)
+        self._setup_scratch(nodes=new_nodes)
+        self._setup_passwordless_ssh(nodes=new_nodes)
 
     def clean_cluster(self, nodes, master, user, user_shell, volumes):
         pass
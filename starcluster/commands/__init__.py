@@ -23,6 +23,7 @@ from terminate import CmdTerminate
 from restart import CmdRestart
 from sshmaster import CmdSshMaster
 from sshnode import CmdSshNode
+from run import CmdRun
 from sshinstance import CmdSshInstance
 from listclusters import CmdListClusters
 from s3image import CmdS3Image
@@ -65,6 +66,7 @@ all_cmds = [
     CmdListClusters(),
     CmdSshMaster(),
     CmdSshNode(),
+    CmdRun(),
     CmdPut(),
     CmdGet(),
     CmdAddNode(),
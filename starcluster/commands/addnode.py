@@ -111,6 +111,11 @@ class CmdAddNode(ClusterCompleter):
             "the hardware. If the node is a spot instance, it "
             "will be terminated instead since it cannot be stopped. Defaults "
             "to false.")
+        parser.add_option(
+            "--timeline", dest="timeline_file", action="store",
+            type="string", default=None, help="write a JSON timeline of "
+            "the time each new node spent in each stage of the add to "
+            "TIMELINE_FILE")
         parser.add_option(
             "--ignore-grp", dest="ignore_grp", action="store_true",
             default=False,
@@ -149,4 +154,5 @@ class CmdAddNode(ClusterCompleter):
                           no_create=self.opts.no_create,
                           reboot_interval=self.opts.reboot_interval,
                           n_reboot_restart=self.opts.n_reboot_restart,
-                          placement_group=placement_group)
+                          placement_group=placement_group,
+                          timeline_file=self.opts.timeline_file)
@@ -30,7 +30,17 @@ class CmdListClusters(ClusterCompleter):
         parser.add_option("-s", "--show-ssh-status", dest="show_ssh_status",
                           action="store_true", default=False,
                           help="output whether SSH is up on each node or not")
+        parser.add_option("--ssh-port-only", dest="ssh_port_only",
+                          action="store_true", default=False,
+                          help="with -s, only check that the SSH port "
+                          "accepts connections (do not authenticate)")
+        parser.add_option("--ssh-timeout", dest="ssh_timeout",
+                          action="store", type="int", default=10,
+                          help="with -s, timeout in seconds of each SSH "
+                          "check (default: 10)")
 
     def execute(self, args):
         self.cm.list_clusters(cluster_groups=args,
-                              show_ssh_status=self.opts.show_ssh_status)
+                              show_ssh_status=self.opts.show_ssh_status,
+                              ssh_timeout=self.opts.ssh_timeout,
+                              ssh_port_only=self.opts.ssh_port_only)
@@ -0,0 +1,88 @@
+# Copyright 2009-2014 Justin Riley
+#
+# This file is part of StarCluster.
+#
+# StarCluster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# StarCluster is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+
+from completers import ClusterCompleter
+
+from starcluster.logger import log
+
+
+class CmdRun(ClusterCompleter):
+    """
+    run [options] <cluster_tag> <remote-command>
+
+    Execute a command on all nodes of a cluster in parallel
+
+    Nodes that return identical output and exit status are grouped together
+    in the output. Exits with a non-zero status if the command failed on any
+    node.
+
+    Examples:
+
+        $ starcluster run mycluster 'uptime'
+        $ starcluster run -n master,node001 mycluster 'df -h /home'
+    """
+    names = ['run']
+
+    def addopts(self, parser):
+        parser.add_option("-n", "--nodes", dest="nodes", action="store",
+                          type="string", default=None,
+                          help="comma-separated list of nodes (aliases or "
+                          "ids) to run the command on (default: all nodes)")
+        parser.add_option("-c", "--concurrency", dest="concurrency",
+                          action="store", type="int", default=20,
+                          help="maximum number of nodes to run the command "
+                          "on at a time (default: 20)")
+        parser.add_option("-t", "--timeout", dest="timeout", action="store",
+                          type="int", default=None,
+                          help="give up on nodes that have not finished "
+                          "after TIMEOUT seconds")
+
+    def execute(self, args):
+        if len(args) < 2:
+            self.parser.error("please specify a cluster and a command")
+        cl = self.cm.get_cluster(args[0], load_plugins=False,
+                                 load_volumes=False)
+        nodes = None
+        if self.opts.nodes:
+            nodes = [cl.get_node(n.strip())
+                     for n in self.opts.nodes.split(',')]
+        cmd = ' '.join(args[1:])
+        groups = {}
+        for node, status, output in cl.execute_on_nodes(
+                cmd, nodes=nodes, concurrency=self.opts.concurrency,
+                timeout=self.opts.timeout):
+            if status != 0:
+                log.warn("%s: command failed (exit status: %s)" %
+                         (node.alias, status))
+            groups.setdefault((status, tuple(output)), []).append(node.alias)
+        failed = 0
+        for (status, output), aliases in sorted(
+                groups.items(), key=lambda g: (-len(g[1]), sorted(g[1]))):
+            aliases.sort()
+            print '-' * 79
+            print "%s (%d node(s), exit status: %s)" % (
+                ', '.join(aliases), len(aliases), status)
+            print '-' * 79
+            for line in output:
+                print line
+            if status != 0:
+                failed += len(aliases)
+        if failed:
+            log.error("command failed on %d node(s)" % failed)
+            sys.exit(1)
@@ -61,6 +61,11 @@ class CmdStart(ClusterCompleter):
                           action="store_true", default=False,
                           help="only launch/start EC2 instances, "
                           "do not perform any setup routines")
+        parser.add_option("--pipelined", dest="pipelined",
+                          action="store_true", default=False,
+                          help="configure the master and then add each "
+                          "worker as soon as it comes up rather than "
+                          "waiting for all nodes to come up")
         parser.add_option("-v", "--validate-only", dest="validate_only",
                           action="store_true", default=False,
                           help="only validate cluster settings, do "
@@ -280,7 +285,8 @@ class CmdStart(ClusterCompleter):
             scluster.start(create=create, create_only=create_only,
                            validate=validate, validate_only=validate_only,
                            validate_running=validate_running,
-                           save_config_on_master=self.opts.config_on_master)
+                           save_config_on_master=self.opts.config_on_master,
+                           pipelined=self.opts.pipelined)
         except KeyboardInterrupt:
             if validate_only:
                 raise
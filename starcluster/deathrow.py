@@ -90,5 +90,8 @@ def _load_plugins(plugins, debug=True):
                 (setup_class, exc.__class__.__name__, exc.message))
         if not hasattr(plug_obj, '__name__'):
             setattr(plug_obj, '__name__', plugin_name)
+        for dep_setting in ['requires', 'after']:
+            if plugin.get(dep_setting) and dep_setting not in kwargs:
+                setattr(plug_obj, dep_setting, plugin.get(dep_setting))
         plugs.append(plug_obj)
     return plugs
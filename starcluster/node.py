@@ -23,7 +23,9 @@ import socket
 import posixpath
 import subprocess
 import datetime
+import Queue
 import tempfile
+import threading
 import os
 
 import config
@@ -87,19 +89,27 @@ class Node(object):
 
     'user' keyword optionally specifies user to ssh as (defaults to root)
     """
-    def __init__(self, instance, key_location, alias=None, user='root'):
+    # unbundled user data shared by all nodes of the same reservation
+    _reservation_user_data = {}
+    _reservation_locks = {}
+    _reservation_lock = threading.Lock()
+
+    def __init__(self, instance, key_location, alias=None, user='root',
+                 persistent_ssh=False):
         self.instance = instance
         self.ec2 = awsutils.EasyEC2(instance.connection.aws_access_key_id,
                                     instance.connection.aws_secret_access_key,
                                     connection=instance.connection)
         self.key_location = key_location
         self.user = user
+        self.persistent_ssh = persistent_ssh
         self._alias = alias
         self._groups = None
         self._ssh = None
         self._num_procs = None
         self._memory = None
         self._user_data = None
+        self._spot_request = None
 
     def __repr__(self):
         return '<Node: %s (%s)>' % (self.alias, self.id)
@@ -119,19 +129,38 @@ class Node(object):
                           "retrying fetching user data (tries: %s)" % (i + 1))
                 time.sleep(5)
 
+    def _unbundle_user_data(self):
+        try:
+            raw = self._get_user_data()
+            return userdata.unbundle_userdata(raw)
+        except IOError, e:
+            parent_cluster = self.parent_cluster
+            if self.parent_cluster:
+                raise exception.IncompatibleCluster(parent_cluster)
+            else:
+                raise exception.BaseException(
+                    "Error occurred unbundling userdata: %s" % e)
+
+    @property
+    def reservation_id(self):
+        return getattr(self.instance, 'reservation_id', None)
+
     @property
     def user_data(self):
+        """
+        Instances launched by the same request share their user data so it
+        is fetched and unbundled at most once per reservation
+        """
         if not self._user_data:
-            try:
-                raw = self._get_user_data()
-                self._user_data = userdata.unbundle_userdata(raw)
-            except IOError, e:
-                parent_cluster = self.parent_cluster
-                if self.parent_cluster:
-                    raise exception.IncompatibleCluster(parent_cluster)
-                else:
-                    raise exception.BaseException(
-                        "Error occurred unbundling userdata: %s" % e)
+            key = self.reservation_id or self.id
+            cache = Node._reservation_user_data
+            with Node._reservation_lock:
+                lock = Node._reservation_locks.setdefault(
+                    key, threading.Lock())
+            with lock:
+                if key not in cache:
+                    cache[key] = self._unbundle_user_data()
+            self._user_data = cache[key]
         return self._user_data
 
     def get_aliases(self, index):
@@ -149,22 +178,52 @@ class Node(object):
     def alias(self):
         """
         Fetches the node's alias stored in a tag from either the instance
-        or the instance's parent spot request. If no alias tag is found an
-        exception is raised.
+        or the instance's parent spot request. Untagged nodes fall back to
+        the alias in the (per-reservation) user data for their launch index
+        and are tagged. If no alias is found an exception is raised.
+
+        Spot instances always have launch index 0 and batched spot requests
+        share one user data bundle so spot nodes only fall back to user data
+        listing a single alias (ie one request per alias).
         """
         if not self._alias:
+            tags = {}
             alias = self.tags.get('alias')
-            if not alias:
+            if not alias and self.spot_id:
+                alias = self._get_spot_alias()
+            elif not alias:
                 alias = self.get_aliases(self.ami_launch_index)
-                if not alias:
-                    raise exception.BaseException(
-                        "instance %s has no alias" % self.id)
-                self.add_tag('alias', alias)
+            if not alias:
+                raise exception.BaseException(
+                    "instance %s has no alias" % self.id)
+            if not self.tags.get('alias'):
+                tags['alias'] = alias
             if not self.tags.get('Name'):
-                self.add_tag('Name', alias)
+                tags['Name'] = alias
+            self.ec2.create_tags([self], tags)
             self._alias = alias
         return self._alias
 
+    def _get_spot_alias(self, tries=5):
+        """
+        Returns the alias tag of this node's spot request, refetching the
+        request in case the tag has not propagated yet
+        """
+        for i in xrange(tries):
+            if self.spot_request:
+                alias = self.spot_request.tags.get('alias')
+                if alias:
+                    return alias
+            aliasestxt = self.user_data.get(static.UD_ALIASES_FNAME, '')
+            aliases = aliasestxt.splitlines()[2:]
+            if len(aliases) == 1:
+                return aliases[0]
+            if i < tries - 1:
+                log.debug("spot request %s has no alias tag yet (tries: %s)"
+                          % (self.spot_id, i + 1))
+                time.sleep(i + 1)
+                self._spot_request = None
+
     @property
     def short_alias(self):
         return self.alias.split(".", 1)[0]
@@ -173,17 +232,15 @@ class Node(object):
         """
         Used to reset the name and alias when there is a conflict
         """
-        self.remove_tag("alias")
-        self.remove_tag("Name")
-        self.add_tag("Name", new_name)
-        self.add_tag("alias", new_name)
+        self.ec2.create_tags([self], {"Name": new_name, "alias": new_name})
         while True:
+            self.update()
             tags = self.tags
             if tags.get("Name", "") == new_name \
                     and tags.get("alias", "") == new_name:
                 break
             log.info("Waiting for new name to propagate")
-            time.sleep(5)
+            time.sleep(2)
 
     def get_plugins_org_metadata(self):
         plugstxt = self.user_data.get(static.UD_PLUGINS_FNAME)
@@ -245,10 +302,16 @@ class Node(object):
         return self.instance.tags
 
     def add_tag(self, key, value=None):
-        return self.instance.add_tag(key, value)
+        try:
+            return self.instance.add_tag(key, value)
+        finally:
+            self.ec2.invalidate_instance_cache()
 
     def remove_tag(self, key, value=None):
-        return self.instance.remove_tag(key, value)
+        try:
+            return self.instance.remove_tag(key, value)
+        finally:
+            self.ec2.invalidate_instance_cache()
 
     @property
     def groups(self):
@@ -752,24 +815,24 @@ class Node(object):
 
     def start_nfs_server(self):
         log.info("Starting NFS server on %s" % self.alias)
-        self.ssh.execute('/etc/init.d/portmap start', ignore_exit_status=True)
-        self.ssh.execute('mount -t rpc_pipefs sunrpc /var/lib/nfs/rpc_pipefs/',
-                         ignore_exit_status=True)
         EXPORTSD = '/etc/exports.d'
         DUMMY_EXPORT_DIR = '/dummy_export_for_broken_init_script'
         DUMMY_EXPORT_LINE = ' '.join([DUMMY_EXPORT_DIR,
                                       '127.0.0.1(ro,no_subtree_check)'])
         DUMMY_EXPORT_FILE = posixpath.join(EXPORTSD, 'dummy.exports')
-        # Hack to get around broken debian nfs-kernel-server script
-        # http://bugs.debian.org/cgi-bin/bugreport.cgi?bug=679274
-        self.ssh.execute("mkdir -p %s" % EXPORTSD)
-        self.ssh.execute("mkdir -p %s" % DUMMY_EXPORT_DIR)
-        with self.ssh.remote_file(DUMMY_EXPORT_FILE, 'w') as dummyf:
-            dummyf.write(DUMMY_EXPORT_LINE)
-        self.ssh.execute('/etc/init.d/nfs start')
-        self.ssh.execute('rm -f %s' % DUMMY_EXPORT_FILE)
-        self.ssh.execute('rm -rf %s' % DUMMY_EXPORT_DIR)
-        self.ssh.execute('exportfs -fra')
+        with self.ssh.batch() as batch:
+            batch.add('/etc/init.d/portmap start', ignore_exit_status=True)
+            batch.add('mount -t rpc_pipefs sunrpc /var/lib/nfs/rpc_pipefs/',
+                      ignore_exit_status=True)
+            # Hack to get around broken debian nfs-kernel-server script
+            # http://bugs.debian.org/cgi-bin/bugreport.cgi?bug=679274
+            batch.add("mkdir -p %s" % EXPORTSD)
+            batch.add("mkdir -p %s" % DUMMY_EXPORT_DIR)
+            batch.write_file(DUMMY_EXPORT_FILE, DUMMY_EXPORT_LINE)
+            batch.add('/etc/init.d/nfs start')
+            batch.add('rm -f %s' % DUMMY_EXPORT_FILE)
+            batch.add('rm -rf %s' % DUMMY_EXPORT_DIR)
+            batch.add('exportfs -fra')
 
     def mount_nfs_shares(self, server_node, remote_paths):
         """
@@ -995,6 +1058,20 @@ class Node(object):
         if spot:
             return spot[0]
 
+    @property
+    def spot_request(self):
+        """
+        The node's parent spot request (fetched once, None for flat-rate
+        nodes)
+        """
+        if self._spot_request is None and self.spot_id:
+            self._spot_request = self.get_spot_request()
+        return self._spot_request
+
+    @spot_request.setter
+    def spot_request(self, spot):
+        self._spot_request = spot
+
     def is_master(self):
         return self.alias.find("master") != -1
 
@@ -1031,7 +1108,10 @@ class Node(object):
         if not self.is_ebs_backed():
             raise exception.InvalidOperation(
                 "Only EBS-backed instances can be started")
-        return self.instance.start()
+        try:
+            return self.instance.start()
+        finally:
+            self.ec2.invalidate_instance_cache()
 
     def stop(self):
         """
@@ -1050,7 +1130,10 @@ class Node(object):
                 "Only EBS-backed instances can be stopped")
         if not self.is_stopped():
             log.info("Stopping node: %s (%s)" % (self.alias, self.id))
-            return self.instance.stop()
+            try:
+                return self.instance.stop()
+            finally:
+                self.ec2.invalidate_instance_cache()
         else:
             log.info("Node '%s' is already stopped" % self.alias)
 
@@ -1068,7 +1151,10 @@ class Node(object):
                 log.error("Spot request matching node {} not found"
                           .format(self.id), exc_info=True)
         log.info("Terminating node: %s (%s)" % (self.alias, self.id))
-        return self.instance.terminate()
+        try:
+            return self.instance.terminate()
+        finally:
+            self.ec2.invalidate_instance_cache()
 
     def shutdown(self):
         """
@@ -1086,6 +1172,7 @@ class Node(object):
         Reboot this instance.
         """
         self.instance.reboot()
+        self.ec2.invalidate_instance_cache()
         if self._ssh:
             self._ssh.close()
             self._ssh = None
@@ -1100,6 +1187,43 @@ class Node(object):
                         .format(self.alias), exc_info=True)
             return False
 
+    def is_ssh_port_open(self, timeout=5):
+        """
+        Returns True if this node accepts TCP connections on the SSH port
+        (without authenticating)
+        """
+        try:
+            sock = socket.create_connection((self.addr, 22), timeout)
+            sock.close()
+            return True
+        except (socket.error, socket.timeout):
+            return False
+
+    def probe_ssh(self, timeout=10, port_only=False):
+        """
+        Returns True if SSH is up on this node based on the instance's
+        current state data. Unlike is_up this uses a new, short-lived SSH
+        connection with a timeout of timeout seconds (or only checks the SSH
+        port if port_only is True).
+        """
+        if self.state != 'running' or not self.addr:
+            return False
+        if port_only:
+            return self.is_ssh_port_open(timeout)
+        try:
+            client = sshutils.SSHClient(self.addr, username=self.user,
+                                        private_key=self.key_location,
+                                        timeout=timeout)
+        except exception.SSHError:
+            return False
+        try:
+            client.connect()
+            return True
+        except (exception.SSHError, socket.error):
+            return False
+        finally:
+            client.close()
+
     def is_impaired(self):
         return bool(self.ec2.conn.get_all_instance_status(
             instance_ids=[self.id],
@@ -1138,8 +1262,14 @@ class Node(object):
         while not self.is_up() and nrm.check():
             time.sleep(interval)
 
-    def is_up(self):
-        if self.update() != 'running':
+    def is_up(self, update=True):
+        """
+        Returns True if the instance is running and SSH is up. Pass
+        update=False when the instance data was just refreshed (e.g. by
+        Cluster.refresh_nodes) to skip the DescribeInstances call.
+        """
+        state = self.update() if update else self.state
+        if state != 'running':
             log.info(self.alias + " is not running")
             return False
         try:
@@ -1197,9 +1327,9 @@ class Node(object):
     @property
     def ssh(self):
         if not self._ssh:
-            self._ssh = sshutils.SSHClient(self.addr,
-                                           username=self.user,
-                                           private_key=self.key_location)
+            self._ssh = sshutils.SSHClient(
+                self.addr, username=self.user, private_key=self.key_location,
+                persistent_session=self.persistent_ssh)
         return self._ssh
 
     def shell(self, user=None, forward_x11=False, forward_agent=False,
@@ -1330,6 +1460,52 @@ class Node(object):
             self._ssh.close()
 
 
+class SSHProber(object):
+    """
+    Probes SSH (see Node.probe_ssh) on many nodes in the background with at
+    most concurrency probes at a time. Results can be collected in any
+    order with get(), which waits for the node's probe to complete.
+    """
+
+    def __init__(self, nodes, concurrency=20, timeout=10, port_only=False):
+        self.timeout = timeout
+        self.port_only = port_only
+        self._results = {}
+        self._done = dict([(n.id, threading.Event()) for n in nodes])
+        self._queue = Queue.Queue()
+        for node in nodes:
+            self._queue.put(node)
+        for i in xrange(min(concurrency, len(nodes))):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+
+    def _work(self):
+        while True:
+            try:
+                node = self._queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                up = node.probe_ssh(timeout=self.timeout,
+                                    port_only=self.port_only)
+            except Exception:
+                log.debug("SSH probe of %s failed" % node.id, exc_info=True)
+                up = False
+            self._results[node.id] = up
+            self._done[node.id].set()
+
+    def get(self, node):
+        """
+        Returns True if SSH is up on node (waiting for its probe)
+        """
+        done = self._done[node.id]
+        while not done.is_set():
+            # wait with a timeout so that KeyboardInterrupt is handled
+            done.wait(1)
+        return self._results[node.id]
+
+
 class NodeRecoveryManager(object):
     def __init__(self, node, reboot_interval, n_reboot_restart):
         self.node = node
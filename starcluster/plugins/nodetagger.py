@@ -34,22 +34,19 @@ class NodeTagger(clustersetup.DefaultClusterSetup):
         self.tags = dict([tag.split('=') for tag in tags.split(',')])
         super(NodeTagger, self).__init__(**kwargs)
 
+    def _tag_nodes(self, nodes):
+        for tag in self.tags:
+            log.info('Applying tag %s:%s to %s' %
+                     (tag, self.tags[tag],
+                      ', '.join([node.alias for node in nodes])))
+        nodes[0].ec2.create_tags(nodes, self.tags)
+
     def run(self, nodes, master, user, user_shell, volumes):
         self._master = master
-        tags = self.tags
-        for tag in tags:
-            log.info('Applying tag %s:%s to master' % (tag, tags[tag]))
-            master.add_tag(tag, tags[tag])
-            for node in nodes:
-                log.info('Applying tag %s:%s to %s' % (tag, tags[tag],
-                                                       node.alias))
-                node.add_tag(tag, tags[tag])
+        self._tag_nodes([master] + [n for n in nodes if n.id != master.id])
 
     def on_add_node(self, node, nodes, master, user, user_shell, volumes):
-        tags = self.tags
-        for tag in tags:
-            log.info('Applying tag %s:%s to %s' % (tag, tags[tag], node.alias))
-            node.add_tag(tag, tags[tag])
+        self._tag_nodes([node])
 
     def on_remove_node(self, node, nodes, master, user, user_shell, volumes):
         log.info('No action required on node removal')
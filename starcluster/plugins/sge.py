@@ -48,12 +48,18 @@ class SGEPlugin(clustersetup.DefaultClusterSetup):
         super(SGEPlugin, self).__init__(**kwargs)
 
     def _add_sge_submit_host(self, node):
+        self._add_sge_submit_hosts([node])
+
+    def _add_sge_submit_hosts(self, nodes):
         mssh = self._master.ssh
-        mssh.execute('qconf -as %s' % node.alias)
+        mssh.execute('qconf -as %s' % ','.join([n.alias for n in nodes]))
 
     def _add_sge_admin_host(self, node):
+        self._add_sge_admin_hosts([node])
+
+    def _add_sge_admin_hosts(self, nodes):
         mssh = self._master.ssh
-        mssh.execute('qconf -ah %s' % node.alias)
+        mssh.execute('qconf -ah %s' % ','.join([n.alias for n in nodes]))
 
     def _setup_sge_profile(self, node):
         sge_profile = node.ssh.remote_file(self.SGE_PROFILE, "w")
@@ -169,15 +175,25 @@ class SGEPlugin(clustersetup.DefaultClusterSetup):
         self._create_sge_pe()
 
     def _remove_from_sge(self, node, only_clean_master=False):
+        self._remove_nodes_from_sge([node], only_clean_master)
+
+    def _remove_nodes_from_sge(self, removed_nodes, only_clean_master=False):
         master = self._master
-        master.ssh.execute('qconf -dattr hostgroup hostlist %s @allhosts' %
-                           node.alias)
-        master.ssh.execute('qconf -purge queue slots all.q@%s' % node.alias)
-        master.ssh.execute('qconf -dconf %s' % node.alias)
-        master.ssh.execute('qconf -de %s' % node.alias)
+        with master.ssh.batch() as batch:
+            for node in removed_nodes:
+                batch.add('qconf -dattr hostgroup hostlist %s @allhosts' %
+                          node.alias)
+                batch.add('qconf -purge queue slots all.q@%s' % node.alias)
+                batch.add('qconf -dconf %s' % node.alias)
+                batch.add('qconf -de %s' % node.alias)
         if not only_clean_master:
-            node.ssh.execute('pkill -9 sge_execd', ignore_exit_status=True)
-        nodes = filter(lambda n: n.alias != node.alias, self._nodes)
+            for node in removed_nodes:
+                self.pool.simple_job(node.ssh.execute, ('pkill -9 sge_execd',),
+                                     kwargs=dict(ignore_exit_status=True),
+                                     jobid=node.alias)
+            self.pool.wait(numtasks=len(removed_nodes))
+        aliases = [n.alias for n in removed_nodes]
+        nodes = filter(lambda n: n.alias not in aliases, self._nodes)
         self._create_sge_pe(nodes=nodes)
 
     def get_nodes_to_recover(self, nodes):
@@ -333,17 +349,23 @@ class SGEPlugin(clustersetup.DefaultClusterSetup):
         self._nodes = None
 
     def on_add_node(self, node, nodes, master, user, user_shell, volumes):
+        self.on_add_nodes([node], nodes, master, user, user_shell, volumes)
+
+    def on_add_nodes(self, new_nodes, nodes, master, user, user_shell,
+                     volumes):
         self._nodes = nodes
         self._master = master
         self._user = user
         self._user_shell = user_shell
         self._volumes = volumes
-        log.info("Adding %s to SGE" % node.alias)
-        self._setup_nfs(nodes=[node], export_paths=[self.SGE_ROOT],
+        log.info("Adding %s to SGE" % ', '.join([n.alias for n in new_nodes]))
+        self._setup_nfs(nodes=new_nodes, export_paths=[self.SGE_ROOT],
                         start_server=False)
-        self._add_sge_admin_host(node)
-        self._add_sge_submit_host(node)
-        self._add_to_sge(node)
+        self._add_sge_admin_hosts(new_nodes)
+        self._add_sge_submit_hosts(new_nodes)
+        for node in new_nodes:
+            self.pool.simple_job(self._add_to_sge, (node,), jobid=node.alias)
+        self.pool.wait(numtasks=len(new_nodes))
         self._create_sge_pe()
 
         # fix to allow pickling
@@ -357,14 +379,20 @@ class SGEPlugin(clustersetup.DefaultClusterSetup):
             self._pool = None
 
     def on_remove_node(self, node, nodes, master, user, user_shell, volumes):
+        self.on_remove_nodes([node], nodes, master, user, user_shell,
+                             volumes)
+
+    def on_remove_nodes(self, removed_nodes, nodes, master, user, user_shell,
+                        volumes):
         self._nodes = nodes
         self._master = master
         self._user = user
         self._user_shell = user_shell
         self._volumes = volumes
-        log.info("Removing %s from SGE" % node.alias)
-        self._remove_from_sge(node)
-        self._remove_nfs_exports(node)
+        log.info("Removing %s from SGE" %
+                 ', '.join([n.alias for n in removed_nodes]))
+        self._remove_nodes_from_sge(removed_nodes)
+        self._remove_nodes_nfs_exports(removed_nodes)
 
         # fix to allow pickling
         self._nodes = None
@@ -0,0 +1,95 @@
+# Copyright 2009-2014 Justin Riley
+#
+# This file is part of StarCluster.
+#
+# StarCluster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# StarCluster is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Local cache of cluster receipts
+"""
+import os
+import re
+import hashlib
+import tempfile
+import cPickle
+
+from starcluster import static
+from starcluster.logger import log
+
+
+class ReceiptCache(object):
+    """
+    On-disk cache of the settings, plugin metadata and volumes a cluster was
+    launched with (its receipt) keyed by cluster tag and security group id.
+
+    Each receipt is stored with a version computed from the cluster
+    group's tags and the master's instance id. Any change to either (eg a
+    new receipt or plugin settings stored in the tags or a new master)
+    invalidates the cached receipt.
+    """
+
+    def __init__(self, directory=static.STARCLUSTER_RECEIPT_CACHE_DIR):
+        self.directory = directory
+
+    def _get_path(self, cluster_tag, group):
+        name = re.sub(r'[^\w.-]+', '-', '_'.join([cluster_tag, group.id]))
+        return os.path.join(self.directory, name + '.pkl')
+
+    @staticmethod
+    def get_version(group, master_id):
+        sha = hashlib.sha1(master_id or '')
+        for item in sorted(group.tags.items()):
+            sha.update(repr(item))
+        return sha.hexdigest()
+
+    def has(self, cluster_tag, group):
+        """
+        Returns True if a receipt (possibly out of date) is cached
+        """
+        return os.path.isfile(self._get_path(cluster_tag, group))
+
+    def get(self, cluster_tag, group, master_id):
+        """
+        Returns the cached receipt (a dict) or None if there is no receipt
+        cached for the current version of the cluster
+        """
+        path = self._get_path(cluster_tag, group)
+        try:
+            with open(path, 'rb') as f:
+                version, receipt = cPickle.load(f)
+        except Exception:
+            return None
+        if version != self.get_version(group, master_id):
+            log.debug("Cached receipt for %s is out of date" % cluster_tag)
+            return None
+        return receipt
+
+    def put(self, cluster_tag, group, master_id, receipt):
+        version = self.get_version(group, master_id)
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, 'wb') as f:
+                cPickle.dump((version, receipt), f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, self._get_path(cluster_tag, group))
+        except (IOError, OSError, cPickle.PicklingError):
+            log.debug("Failed to cache receipt for %s" % cluster_tag,
+                      exc_info=True)
+
+    def invalidate(self, cluster_tag, group):
+        try:
+            os.remove(self._get_path(cluster_tag, group))
+        except OSError:
+            pass
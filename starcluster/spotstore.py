@@ -0,0 +1,135 @@
+# Copyright 2009-2014 Justin Riley
+#
+# This file is part of StarCluster.
+#
+# StarCluster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# StarCluster is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Local incremental store for EC2 spot price history
+"""
+import os
+import re
+import json
+import time
+import tempfile
+import threading
+
+from starcluster import utils
+from starcluster import static
+from starcluster.logger import log
+
+
+class SpotPriceStore(object):
+    """
+    On-disk spot price time series keyed by region, instance type, product
+    description and zone.
+
+    Every series remembers the time window it covers so that only prices
+    newer than the last fetch are requested from EC2. Series that were
+    fetched less than max_age seconds ago are served from disk as is and
+    records older than retention_days are pruned.
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, directory=static.STARCLUSTER_SPOT_HISTORY_DIR,
+                 retention_days=90, max_age=300):
+        self.directory = directory
+        self.retention_days = retention_days
+        self.max_age = max_age
+
+    def _get_path(self, region, instance_type, product_description, zone):
+        name = '_'.join([region, instance_type, product_description,
+                         zone or 'all'])
+        return os.path.join(self.directory,
+                            re.sub(r'[^\w.-]+', '-', name) + '.json')
+
+    def _load(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return dict(start=None, end=None, records=[])
+
+    def _save(self, path, series):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(series, f)
+        os.rename(tmp_path, path)
+
+    @staticmethod
+    def _select(records, start, end):
+        """
+        Returns the records between start and end plus, for each zone, the
+        last record before start (ie the price in effect at start) sorted
+        newest first
+        """
+        selected = []
+        in_effect = {}
+        for rec in records:
+            ts, price, zone = rec
+            if start <= ts <= end:
+                selected.append(rec)
+            elif ts < start and ts > in_effect.get(zone, [-1])[0]:
+                in_effect[zone] = rec
+        selected.extend(in_effect.values())
+        selected.sort(reverse=True)
+        return selected
+
+    def get_history(self, fetch_func, region, instance_type,
+                    product_description, zone=None, start=None, end=None):
+        """
+        Returns a list of [unix_time, price, zone] records, newest first,
+        for the window start-end (unix times, defaults to the full
+        retention window up until now). Data missing from the store is
+        fetched by calling fetch_func(start_iso, end_iso) which must return
+        a list of boto SpotPriceHistory objects.
+        """
+        now = time.time()
+        oldest = now - self.retention_days * 86400
+        start = max(start or oldest, oldest)
+        end = min(end or now, now)
+        path = self._get_path(region, instance_type, product_description,
+                              zone)
+        with self._lock:
+            series = self._load(path)
+            fetch_start = fetch_end = None
+            if series['start'] is None or start < series['start']:
+                fetch_start = start
+                fetch_end = max(end, series['end'] or end)
+                series['records'] = []
+                series['start'] = start
+            elif end > series['end'] and now - series['end'] > self.max_age:
+                fetch_start = series['end']
+                fetch_end = end
+            if fetch_start is not None:
+                log.debug("Fetching spot history for %s (%s) in %s from %s "
+                          "to %s" % (instance_type, product_description,
+                                     zone or 'all zones', fetch_start,
+                                     fetch_end))
+                hist = fetch_func(utils.unix_time_to_iso(fetch_start),
+                                  utils.unix_time_to_iso(fetch_end))
+                records = dict([((r[0], r[2]), r)
+                                for r in series['records']])
+                for item in hist:
+                    ts = utils.iso_to_unix_time(item.timestamp)
+                    records[(ts, item.availability_zone)] = [
+                        ts, item.price, item.availability_zone]
+                series['end'] = max(fetch_end, series['end'] or fetch_end)
+                series['start'] = max(series['start'], oldest)
+                series['records'] = self._select(
+                    records.values(), series['start'], series['end'])
+                self._save(path, series)
+        return self._select(series['records'], start, end)
@@ -20,12 +20,16 @@ import re
 import sys
 import stat
 import glob
+import Queue
+import pipes
 import atexit
 import string
 import socket
 import fnmatch
 import hashlib
+import collections
 import warnings
+import threading
 import posixpath
 import tempfile
 
@@ -47,6 +51,12 @@ from starcluster import progressbar
 from starcluster.logger import log
 
 
+# parsed private keys shared by all SSHClient instances keyed by
+# (path, mtime, passphrase hash) - see SSHClient.load_private_key
+_pkey_cache = {}
+_pkey_cache_lock = threading.Lock()
+
+
 class SSHClient(object):
     """
     Establishes an SSH connection to a remote host using either password or
@@ -63,7 +73,8 @@ class SSHClient(object):
                  private_key_pass=None,
                  compress=False,
                  port=22,
-                 timeout=60):
+                 timeout=60,
+                 persistent_session=False):
         self._host = host
         self._port = port
         self._pkey = None
@@ -72,6 +83,9 @@ class SSHClient(object):
         self._timeout = timeout
         self._sftp = None
         self._scp = None
+        self.persistent_session = persistent_session
+        self._session = None
+        self._session_lock = threading.Lock()
         self._transport = None
         self._progress_bar = None
         self._compress = compress
@@ -84,6 +98,27 @@ class SSHClient(object):
         atexit.register(self.close)
 
     def load_private_key(self, private_key, private_key_pass=None):
+        """
+        Returns the parsed private key (a paramiko PKey) in the file
+        private_key. Keys are parsed once and shared by all SSHClient
+        instances until the key file is modified.
+        """
+        path = os.path.abspath(os.path.expanduser(private_key))
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return self._load_private_key(private_key, private_key_pass)
+        passphrase_hash = None
+        if private_key_pass is not None:
+            passphrase_hash = hashlib.sha1(private_key_pass).hexdigest()
+        cache_key = (path, mtime, passphrase_hash)
+        with _pkey_cache_lock:
+            if cache_key not in _pkey_cache:
+                _pkey_cache[cache_key] = self._load_private_key(
+                    private_key, private_key_pass)
+            return _pkey_cache[cache_key]
+
+    def _load_private_key(self, private_key, private_key_pass=None):
         # Use Private Key.
         log.debug('loading private key %s' % private_key)
         if private_key.endswith('rsa') or private_key.count('rsa'):
@@ -284,12 +319,10 @@ class SSHClient(object):
         If matching is set to False then only lines *not* containing a pattern
         that matches regex will be returned
         """
-        with tempfile.NamedTemporaryFile(
-                prefix=os.path.basename(remote_file) + "_") as f:
-            self.get(remote_file, f.name)
-            flines = f.readlines()
+        flines = self.execute_iter('cat %s' % pipes.quote(remote_file),
+                                   source_profile=False)
         if regex is None:
-            return flines
+            return list(flines)
         r = re.compile(regex)
         lines = []
         for line in flines:
@@ -500,10 +533,66 @@ class SSHClient(object):
     def get_last_status(self):
         return self.__last_status
 
+    def batch(self, source_profile=True, log_output=True):
+        """
+        Returns a RemoteBatch that collects remote commands and runs them all
+        in a single remote script (ie one round trip) when the with block
+        exits, e.g.:
+
+            with node.ssh.batch() as batch:
+                batch.add('mkdir -p /scratch')
+                batch.add('ln -s /mnt/sgeadmin /scratch')
+            status, output = batch.results[0]
+        """
+        return RemoteBatch(self, source_profile=source_profile,
+                           log_output=log_output)
+
+    def _get_session(self):
+        """
+        Returns this client's persistent RemoteShell with its lock held or
+        None if persistent sessions are disabled, the session is busy
+        running another command (ie concurrent calls) or could not be
+        started. Callers must release self._session_lock when done.
+        """
+        if not self.persistent_session:
+            return
+        if not self._session_lock.acquire(False):
+            return
+        try:
+            if not self._session or not self._session.is_active():
+                log.debug("starting persistent shell session on %s" %
+                          self._host)
+                self._session = RemoteShell(self.transport, self._timeout)
+            return self._session
+        except Exception:
+            log.debug("failed to start persistent shell session on %s, "
+                      "falling back to a channel per command" % self._host,
+                      exc_info=True)
+            self.persistent_session = False
+            self._session = None
+            self._session_lock.release()
+
+    def _run_in_session(self, session, command, silent=True,
+                        only_printable=False):
+        try:
+            log.debug("executing remote command in session: %s" % command)
+            exit_status, output = session.run(command, echo=not silent)
+        finally:
+            self._session_lock.release()
+        if only_printable:
+            output = map(lambda line: ''.join(c for c in line if c in
+                                              string.printable), output)
+        output = map(lambda line: line.strip(), output)
+        return exit_status, output
+
     def get_status(self, command, source_profile=True):
         """
         Execute a remote command and return the exit status
         """
+        session = source_profile and self._get_session()
+        if session:
+            self.__last_status = self._run_in_session(session, command)[0]
+            return self.__last_status
         channel = self.transport.open_session()
         channel.settimeout(self._timeout)
         if source_profile:
@@ -561,24 +650,34 @@ class SSHClient(object):
         source_profile - if True prefix the command with "source /etc/profile"
         raise_on_failure - raise exception.SSHError if command fails
         returns List of output lines
+
+        If persistent_session is enabled commands that source the profile
+        run in this client's persistent RemoteShell (with stderr merged into
+        stdout) unless the session is busy or unavailable.
         """
-        channel = self.transport.open_session()
-        channel.settimeout(self._timeout)
-        if detach:
-            command = "nohup %s &" % command
+        session = source_profile and not detach and self._get_session()
+        if session:
+            exit_status, output = self._run_in_session(
+                session, command, silent=silent,
+                only_printable=only_printable)
+        else:
+            channel = self.transport.open_session()
+            channel.settimeout(self._timeout)
+            if detach:
+                command = "nohup %s &" % command
+                if source_profile:
+                    command = "source /etc/profile && %s" % command
+                channel.exec_command(command)
+                channel.close()
+                self.__last_status = None
+                return
             if source_profile:
                 command = "source /etc/profile && %s" % command
+            log.debug("executing remote command: %s" % command)
             channel.exec_command(command)
-            channel.close()
-            self.__last_status = None
-            return
-        if source_profile:
-            command = "source /etc/profile && %s" % command
-        log.debug("executing remote command: %s" % command)
-        channel.exec_command(command)
-        output = self._get_output(channel, silent=silent,
-                                  only_printable=only_printable)
-        exit_status = channel.recv_exit_status()
+            output = self._get_output(channel, silent=silent,
+                                      only_printable=only_printable)
+            exit_status = channel.recv_exit_status()
         self.__last_status = exit_status
         out_str = '\n'.join(output)
         if exit_status != 0:
@@ -603,6 +702,85 @@ class SSHClient(object):
                 log.debug("output of '%s' has been hidden" % command)
         return output
 
+    def execute_iter(self, command, source_profile=True, stderr=False,
+                     ignore_exit_status=False, max_buffered_lines=1000):
+        """
+        Execute a remote command and yield its stdout lines (including
+        newlines) as they arrive instead of returning all output at once
+
+        stdout and stderr are read concurrently in background threads so
+        that a command writing lots of stderr cannot block. At most
+        max_buffered_lines lines are buffered if the caller consumes them
+        slower than they arrive (the remote command is then throttled).
+
+        kwargs:
+        source_profile - if True prefix the command with "source /etc/profile"
+        stderr - also yield stderr lines (by default only the last stderr
+                 lines are kept for error messages)
+        ignore_exit_status - don't raise exception.RemoteCommandFailed after
+                             the last line if the command fails
+        """
+        channel = self.transport.open_session()
+        channel.settimeout(self._timeout)
+        if source_profile:
+            command = "source /etc/profile && %s" % command
+        log.debug("executing remote command: %s" % command)
+        channel.exec_command(command)
+        lines = Queue.Queue(max_buffered_lines)
+        stderr_tail = collections.deque(maxlen=100)
+        done = threading.Event()
+
+        def put(item):
+            while not done.is_set():
+                try:
+                    return lines.put(item, True, 1)
+                except Queue.Full:
+                    pass
+
+        def read(f, tail=None):
+            try:
+                for line in iter(f.readline, ''):
+                    if tail is not None:
+                        tail.append(line)
+                    else:
+                        put(line)
+                put(None)
+            except Exception as e:
+                put(e)
+        readers = [(channel.makefile('rb', -1), None),
+                   (channel.makefile_stderr('rb', -1),
+                    None if stderr else stderr_tail)]
+        for f, tail in readers:
+            reader = threading.Thread(target=read, args=(f, tail))
+            reader.daemon = True
+            reader.start()
+        try:
+            eofs = 0
+            while eofs < len(readers):
+                try:
+                    # wait with a timeout so that KeyboardInterrupt is handled
+                    item = lines.get(True, 1)
+                except Queue.Empty:
+                    continue
+                if item is None:
+                    eofs += 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+            exit_status = channel.recv_exit_status()
+        finally:
+            done.set()
+            channel.close()
+        self.__last_status = exit_status
+        if exit_status != 0:
+            msg = "remote command '%s' failed with status %d" % (command,
+                                                                 exit_status)
+            if not ignore_exit_status:
+                raise exception.RemoteCommandFailed(
+                    msg, command, exit_status, ''.join(stderr_tail))
+            log.debug("(ignored) " + msg)
+
     def has_required(self, progs):
         """
         Same as check_required but returns False if not all commands exist
@@ -640,6 +818,9 @@ class SSHClient(object):
 
     def close(self):
         """Closes the connection and cleans up."""
+        if self._session:
+            self._session.close()
+            self._session = None
         if self._sftp:
             self._sftp.close()
         if self._transport:
@@ -714,8 +895,6 @@ class SSHClient(object):
 
     # thanks to Mike Looijmans for this code
     def _windows_shell(self, chan):
-        import threading
-
         sys.stdout.write("Line-buffered terminal emulation. "
                          "Press F6 or ^Z to send EOF.\r\n\r\n")
 
@@ -755,6 +934,195 @@ class SSHClient(object):
 Connection = SSHClient
 
 
+class RemoteShell(object):
+    """
+    A long-lived remote bash process that runs commands read from its stdin
+    (see SSHClient's persistent_session). The profile is sourced when the
+    shell starts and sourced again before any command that follows a change
+    to the profile or the profile.d scripts (e.g. SGE's sge.sh).
+
+    Each command runs in its own subshell (so that cd, exports, etc. do not
+    leak into later commands) with stdin from /dev/null and stderr merged
+    into stdout. Its output ends with a unique sentinel line carrying the
+    exit status.
+    """
+
+    def __init__(self, transport, timeout=None, profile='/etc/profile',
+                 profile_dir='/etc/profile.d'):
+        self._marker = '__sc_shell_%s__' % os.urandom(8).encode('hex')
+        # stat output (times, sizes, names) of the profile scripts compared
+        # before each command to detect changes
+        stat_paths = ' '.join([pipes.quote(profile), pipes.quote(profile_dir),
+                               pipes.quote(profile_dir) + '/*'])
+        self._source_profile = (
+            '__sc_s=$(stat -c "%%y %%s %%n" %s 2>/dev/null); '
+            '[ "$__sc_s" = "$__sc_stamp" ] || '
+            '{ __sc_stamp=$__sc_s; source %s > /dev/null 2>&1; }\n' %
+            (stat_paths, pipes.quote(profile)))
+        self.channel = transport.open_session()
+        self.channel.settimeout(timeout)
+        self.channel.exec_command('/bin/bash')
+        self._stdin = self.channel.makefile('wb', -1)
+        self._stdout = self.channel.makefile('rb', -1)
+        # make sure the shell works before using it
+        self.run('true')
+
+    def is_active(self):
+        return not self.channel.closed and \
+            not self.channel.exit_status_ready()
+
+    def run(self, command, echo=False):
+        """
+        Runs command and returns a tuple (exit_status, output_lines). Prints
+        output lines as they arrive if echo is True.
+        """
+        try:
+            self._stdin.write(self._source_profile)
+            self._stdin.write('(eval %s) < /dev/null 2>&1\n' %
+                              pipes.quote(command))
+            self._stdin.write('s=$?; echo; echo %s $s\n' % self._marker)
+            self._stdin.flush()
+            output = []
+            while True:
+                line = self._stdout.readline()
+                if not line:
+                    raise exception.SSHError(
+                        "remote shell exited while running '%s'" % command)
+                if self._marker in line:
+                    exit_status = int(line[line.index(self._marker) +
+                                           len(self._marker):])
+                    break
+                # print the previous line so that the newline echoed
+                # before the sentinel is never printed
+                if echo and output:
+                    print output[-1],
+                output.append(line)
+        except Exception:
+            # the shell's state is unknown, start a new one next time
+            self.close()
+            raise
+        # drop the newline echoed before the sentinel
+        if output and output[-1] == '\n':
+            output.pop()
+        elif echo and output:
+            print output[-1],
+        return exit_status, output
+
+    def close(self):
+        self.channel.close()
+
+
+class RemoteBatch(object):
+    """
+    Collects remote commands and runs them in order in a single remote shell
+    script (see SSHClient.batch). Each command runs in its own subshell with
+    stderr redirected to stdout. A failing command stops the script and
+    raises RemoteCommandFailed (just like SSHClient.execute) unless it was
+    added with ignore_exit_status=True, in which case the batch continues.
+
+    After running, results contains an (exit_status, output_lines) tuple for
+    each command (exit_status is None for commands that did not run).
+    """
+
+    def __init__(self, ssh, source_profile=True, log_output=True):
+        self.ssh = ssh
+        self.source_profile = source_profile
+        self.log_output = log_output
+        self.commands = []
+        self.results = None
+        self._marker = '__sc_batch_%s__' % os.urandom(8).encode('hex')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.run()
+
+    def add(self, command, ignore_exit_status=False):
+        """
+        Adds command to the batch and returns its index in results
+        """
+        self.commands.append((command, ignore_exit_status))
+        return len(self.commands) - 1
+
+    def write_file(self, path, contents):
+        """
+        Adds a command that (over)writes the remote file path with contents
+        """
+        return self.add("printf '%%s' %s > %s" %
+                        (pipes.quote(contents), pipes.quote(path)))
+
+    def get_script(self):
+        lines = []
+        for i, (command, ignore_exit_status) in enumerate(self.commands):
+            lines.append("echo %s-%d" % (self._marker, i))
+            lines.append("(\n%s\n) 2>&1" % command)
+            lines.append("s=$?; echo; echo %s-%d-$s" % (self._marker, i))
+            if not ignore_exit_status:
+                lines.append("[ $s -eq 0 ] || exit $s")
+        return '\n'.join(lines)
+
+    def _parse_output(self, output):
+        results = [(None, [])] * len(self.commands)
+        current = None
+        lines = []
+        for line in output:
+            if self._marker not in line:
+                if current is not None:
+                    lines.append(line)
+                continue
+            step = line[line.index(self._marker) + len(self._marker) + 1:]
+            if '-' in step:
+                index, status = step.split('-', 1)
+                # drop the empty line echoed before the end marker
+                if lines and not lines[-1]:
+                    lines.pop()
+                results[int(index)] = (int(status), lines)
+                current = None
+            else:
+                current = int(step)
+                lines = []
+        return results
+
+    def run(self):
+        """
+        Runs all commands in a single remote script and returns results
+        """
+        if not self.commands:
+            self.results = []
+            return self.results
+        script = self.get_script()
+        log.debug("executing %d remote commands in one batch" %
+                  len(self.commands))
+        output = self.ssh.execute(script, ignore_exit_status=True,
+                                  log_output=False,
+                                  source_profile=self.source_profile)
+        self.results = self._parse_output(output)
+        for (command, ignore), (status, out) in zip(self.commands,
+                                                    self.results):
+            out_str = '\n'.join(out)
+            if status is None:
+                if ignore:
+                    continue
+                status = self.ssh.get_last_status()
+                raise exception.RemoteCommandFailed(
+                    "remote batch failed with status %s before running '%s'"
+                    % (status, command), command, status, '\n'.join(output))
+            if status != 0:
+                msg = "remote command '%s' failed with status %d" % (command,
+                                                                     status)
+                if self.log_output:
+                    msg += ":\n%s" % out_str
+                if not ignore:
+                    raise exception.RemoteCommandFailed(msg, command, status,
+                                                        out_str)
+                log.debug("(ignored) " + msg)
+            elif self.log_output:
+                log.debug("output of '%s':\n%s" % (command, out_str))
+        return self.results
+
+
 class SSHGlob(object):
 
     def __init__(self, ssh_client):
@@ -71,6 +71,10 @@ STARCLUSTER_CFG_DIR = os.path.join(os.path.expanduser('~'), '.starcluster')
 STARCLUSTER_CFG_FILE = os.path.join(STARCLUSTER_CFG_DIR, 'config')
 STARCLUSTER_PLUGIN_DIR = os.path.join(STARCLUSTER_CFG_DIR, 'plugins')
 STARCLUSTER_LOG_DIR = os.path.join(STARCLUSTER_CFG_DIR, 'logs')
+STARCLUSTER_SPOT_HISTORY_DIR = os.path.join(STARCLUSTER_CFG_DIR,
+                                            'spothistory')
+STARCLUSTER_RECEIPT_CACHE_DIR = os.path.join(STARCLUSTER_CFG_DIR,
+                                             'receipts')
 STARCLUSTER_RECEIPT_DIR = "/var/run/starcluster"
 STARCLUSTER_RECEIPT_FILE = os.path.join(STARCLUSTER_RECEIPT_DIR, "receipt.pkl")
 STARCLUSTER_OWNER_ID = 342652561657
@@ -270,6 +274,10 @@ AWS_SETTINGS = {
     'aws_proxy_user': (str, False, None, None, None),
     'aws_proxy_pass': (str, False, None, None, None),
     'aws_validate_certs': (bool, False, True, None, None),
+    'aws_instance_cache_ttl': (int, False, None, None, None),
+    'aws_request_rate': (int, False, None, None, None),
+    'aws_request_burst': (int, False, None, None, None),
+    'aws_max_connections': (int, False, None, None, None),
 }
 
 KEY_SETTINGS = {
@@ -285,6 +293,8 @@ EBS_VOLUME_SETTINGS = {
 
 PLUGIN_SETTINGS = {
     'setup_class': (str, True, None, None, None),
+    'requires': (list, False, [], None, None),
+    'after': (list, False, [], None, None),
 }
 
 PERMISSION_SETTINGS = {
@@ -325,7 +335,9 @@ CLUSTER_SETTINGS = {
     'dns_prefix': (bool, False, False, None, None),
     'dns_suffix': (bool, False, False, None, None),
     'subnet_ids': (list, False, [], None, None),
-    'impaired_threshold_sec': (int, False, 120, None, None)
+    'impaired_threshold_sec': (int, False, 120, None, None),
+    'plugin_concurrency': (int, False, 1, None, None),
+    'persistent_ssh': (bool, False, False, None, None)
 }
 
 NODE_SETTINGS = {
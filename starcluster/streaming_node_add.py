@@ -16,6 +16,7 @@
 # along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
 
 import time
+import json
 from functools import partial
 from starcluster.logger import log
 from starcluster import utils
@@ -23,6 +24,46 @@ from starcluster.node import Node
 from starcluster.node import NodeRecoveryManager
 
 
+# (stage, event ending the stage) in pipeline order
+STAGES = [('spot_propagation', 'spot_propagated'),
+          ('spot_fulfillment', 'spot_fulfilled'),
+          ('instance_propagation', 'instance_propagated'),
+          ('boot', 'running'),
+          ('ssh', 'ssh_up'),
+          ('plugins', 'added')]
+
+
+def _percentile(values, pct):
+    values = sorted(values)
+    index = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def summarize_timeline(timeline):
+    """
+    Returns {stage: (count, p50, p95, max)} of the time spent in each stage
+    (plus 'total' for the time to be added) by the nodes of a timeline as
+    recorded by StreamingNodeAdd. Stages a node skipped (eg the spot stages
+    of flat-rate nodes) are ignored.
+    """
+    durations = {}
+    for entry in timeline.values():
+        events = entry['events']
+        last = events['start']
+        for stage, event in STAGES:
+            if event in events:
+                durations.setdefault(stage, []).append(events[event] - last)
+                last = events[event]
+        if 'added' in events:
+            durations.setdefault('total', []).append(
+                events['added'] - events['start'])
+    summary = {}
+    for stage, values in durations.iteritems():
+        summary[stage] = (len(values), _percentile(values, 50),
+                          _percentile(values, 95), max(values))
+    return summary
+
+
 class StreamingNodeAdd(object):
 
     """
@@ -36,9 +77,9 @@ class StreamingNodeAdd(object):
     """
 
     def __init__(self, cluster, spots, instances, reboot_interval,
-                 n_reboot_restart):
-        assert bool(spots) != bool(instances), \
-            "You must define either spots or instances"
+                 n_reboot_restart, timeline_file=None):
+        assert spots or instances, \
+            "You must define spots and/or instances"
         self.cluster = cluster
         self.unpropagated_spots = spots
         self.spots = []
@@ -48,16 +89,76 @@ class StreamingNodeAdd(object):
         self.n_reboot_restart = n_reboot_restart
         self.instances_nrm = {}
         self.ready_instances = []
+        self.waiter = self.cluster.ec2.get_propagation_waiter()
+        # node id -> (is up, time of the check)
+        self.liveness = {}
+        self.liveness_ttl = 300
+        # spot/instance id -> stage transition timestamps
+        self.timeline = {}
+        self.timeline_file = timeline_file
+        # run the user plugins' on_add_nodes hooks as well when adding nodes
+        self.run_user_plugins = True
+        self.start_time = time.time()
+        self.mark(spots + instances, 'start')
+
+    def mark(self, objs, event, now=None):
+        """
+        Record the time at which spots/instances (objs) first reached event
+        """
+        now = now or time.time()
+        for obj in objs:
+            entry = self.timeline.setdefault(
+                obj.id, dict(id=obj.id, events=dict(start=self.start_time)))
+            entry['events'].setdefault(event, now)
+
+    def link_spot(self, spot_id, instance_id):
+        """
+        Continue the timeline of a spot request with its instance's
+        """
+        entry = self.timeline.pop(spot_id, None)
+        if entry:
+            entry.update(id=instance_id, spot_id=spot_id)
+            self.timeline[instance_id] = entry
+
+    def log_timing_summary(self):
+        summary = summarize_timeline(self.timeline)
+        if not summary:
+            return
+        log.info("Node add timings (nodes, p50, p95, max):")
+        for stage in [st[0] for st in STAGES] + ['total']:
+            if stage in summary:
+                count, p50, p95, pmax = summary[stage]
+                log.info("  %s: %d, %.1fs, %.1fs, %.1fs" %
+                         (stage, count, p50, p95, pmax))
+
+    def write_timeline(self):
+        entries = sorted(self.timeline.values(),
+                         key=lambda e: e['events'].get('added'))
+        with open(self.timeline_file, 'w') as f:
+            json.dump(dict(start=self.start_time, nodes=entries,
+                           summary=summarize_timeline(self.timeline)),
+                      f, indent=2)
+        log.info("Wrote node add timeline to %s" % self.timeline_file)
+
+    def stream_propagation(self):
+        """
+        Check the propagation of all unpropagated spots and instances at
+        once
+        """
+        self.waiter.add('spot', self.unpropagated_spots)
+        self.waiter.add('instance', self.unpropagated_instances)
+        if self.waiter.num_pending:
+            self.waiter.check()
 
     def stream_unpropagated_spots(self):
         if not self.unpropagated_spots:
             return
 
-        propagated_spot_ids, _ = self.cluster.ec2.check_for_propagation(
-            spot_ids=[s.id for s in self.unpropagated_spots])
+        propagated_spot_ids = self.waiter.resolved['spot']
         self.unpropagated_spots = utils.filter_move(
             lambda s: s.id not in propagated_spot_ids,
             self.unpropagated_spots, self.spots)
+        self.mark(self.spots, 'spot_propagated')
         if self.unpropagated_spots:
             log.info("Still waiting for unpropagated spots:"
                      + str(self.unpropagated_spots))
@@ -68,9 +169,14 @@ class StreamingNodeAdd(object):
 
         instance_ids = []
         self.spots = self.cluster.get_spot_requests_or_raise(self.spots)
+        fulfilled = []
         self.spots = utils.filter_move(
             lambda s: s.state != 'active' or s.instance_id is None,
-            self.spots, instance_ids, lambda s: s.instance_id)
+            self.spots, fulfilled)
+        for spot in fulfilled:
+            self.mark([spot], 'spot_fulfilled')
+            self.link_spot(spot.id, spot.instance_id)
+            instance_ids.append(spot.instance_id)
         if instance_ids:
             log.info("Instance ids:" + str(instance_ids))
             for instance_id in instance_ids:
@@ -86,11 +192,11 @@ class StreamingNodeAdd(object):
         if not self.unpropagated_instances:
             return
 
-        _, propagated_instance_ids = self.cluster.ec2.check_for_propagation(
-            instance_ids=[s.id for s in self. unpropagated_instances])
+        propagated_instance_ids = self.waiter.resolved['instance']
         self.unpropagated_instances = utils.filter_move(
             lambda i: i.id not in propagated_instance_ids,
             self.unpropagated_instances, self.instances)
+        self.mark(self.instances, 'instance_propagated')
         if self.unpropagated_instances:
             log.info("Still waiting for unpropagated instances: "
                      + str(self.unpropagated_instances))
@@ -105,18 +211,28 @@ class StreamingNodeAdd(object):
                 if isinstance(instance, Node):
                     nrm = nrm_cls(instance)
                 else:
-                    nrm = nrm_cls(Node(instance, self.cluster.key_location))
+                    nrm = nrm_cls(Node(
+                        instance, self.cluster.key_location,
+                        persistent_ssh=self.cluster.persistent_ssh))
                 self.instances_nrm[instance.id] = nrm
 
     def stream_instances(self):
         if not self.instances:
             return
 
-        ssh_up = self.cluster.pool.map(lambda i: i.is_up(), self.instances)
+        self.cluster.refresh_nodes(self.instances)
+        ssh_up = self.cluster.pool.map(lambda i: (i, i.is_up(update=False)),
+                                       self.instances)
+        now = time.time()
+        for i, up in ssh_up:
+            self.set_liveness(i, up)
+            if i.state == 'running':
+                self.mark([i], 'running', now)
+                if up:
+                    self.mark([i], 'ssh_up', now)
         zip_instances = utils.filter_move(
             lambda i: i[0].state != 'running' or not i[1],
-            zip(self.instances, ssh_up), self.ready_instances,
-            lambda i: i[0])
+            ssh_up, self.ready_instances, lambda i: i[0])
         self.instances = [i[0] for i in zip_instances]
         if self.instances:
             log.info("Still waiting for instances: " + str(self.instances))
@@ -129,18 +245,75 @@ class StreamingNodeAdd(object):
         for instance in dead_instances:
             del self.instances_nrm[instance.id]
 
+    def set_liveness(self, node, up):
+        self.liveness[node.id] = (up, time.time())
+
+    def get_up_nodes(self):
+        """
+        Returns the cluster nodes that are running and whose SSH is up. SSH
+        liveness comes from the cache, updated by the instance state
+        refresh and by failures, so only nodes that were not checked in
+        the last liveness_ttl seconds are probed.
+        """
+        now = time.time()
+        nodes = filter(lambda n: n.state == 'running', self.cluster.nodes)
+        stale = [n for n in nodes if n.id not in self.liveness or
+                 now - self.liveness[n.id][1] > self.liveness_ttl]
+        if stale:
+            log.debug("Checking liveness of %d node(s)" % len(stale))
+            ssh_up = self.cluster.pool.map(
+                lambda n: (n, n.is_up(update=False)), stale)
+            for n, up in ssh_up:
+                self.set_liveness(n, up)
+        return [n for n in nodes if self.liveness[n.id][0]]
+
+    def evict_liveness(self, nodes):
+        """
+        Forget the cached liveness of nodes so that it is checked again
+        """
+        for node in nodes:
+            self.liveness.pop(node.id, None)
+
+    def _add_nodes(self, nodes):
+        up_nodes = self.get_up_nodes()
+        try:
+            self.cluster.run_plugins(method_name="on_add_nodes", node=nodes,
+                                     nodes=up_nodes,
+                                     user_plugins=self.run_user_plugins)
+        except:
+            # any of the nodes involved may have died so re-check them all
+            # rather than trusting the cache until it expires
+            self.evict_liveness(up_nodes + list(nodes))
+            raise
+        # success
+        self.mark(nodes, 'added')
+        for node in nodes:
+            self.timeline[node.id]['alias'] = node.alias
+            del self.instances_nrm[node.id]
+
     def stream_ready_instances(self):
+        """
+        Add all ready instances to the cluster at once (on_add_nodes). If
+        that fails they are added one at a time so that only the failing
+        nodes go through reboot handling.
+        """
+        if len(self.ready_instances) > 1:
+            log.info("Adding nodes: %s" %
+                     ', '.join([i.alias for i in self.ready_instances]))
+            try:
+                self._add_nodes(self.ready_instances)
+                return
+            except:
+                log.error("Failed to add nodes together, adding them one "
+                          "at a time", exc_info=True)
         for ready_instance in self.ready_instances:
             log.info("Adding node: %s" % ready_instance.alias)
-            up_nodes = filter(lambda n: n.is_up(), self.cluster.nodes)
             try:
-                self.cluster.run_plugins(method_name="on_add_node",
-                                         node=ready_instance, nodes=up_nodes)
-                # success
-                del self.instances_nrm[ready_instance.id]
+                self._add_nodes([ready_instance])
             except:
                 log.error("Failed to add node {}"
                           .format(ready_instance.alias), exc_info=True)
+                self.set_liveness(ready_instance, False)
                 if self.instances_nrm[ready_instance.id].handle_reboot():
                     # back to not ready list
                     self.instances.append(ready_instance)
@@ -158,6 +331,7 @@ class StreamingNodeAdd(object):
 
         while True:
             self.ready_instances = []
+            self.stream_propagation()
             self.stream_unpropagated_spots()
             self.stream_spots()
             self.stream_unpropagated_instances()
@@ -176,6 +350,46 @@ class StreamingNodeAdd(object):
                 time.sleep(interval)
             else:
                 break
+        self.log_timing_summary()
+        if self.timeline_file:
+            self.write_timeline()
+
+
+class StreamingClusterStart(StreamingNodeAdd):
+
+    """
+    Configure a new cluster as a stream.
+
+    The master is set up as soon as it is ready. Each worker is then added
+    to the cluster through the built-in plugins' on_add_nodes hooks as soon
+    as it is ready rather than waiting for every node of the cluster to be
+    up. Workers that are ready before the master wait for it to be
+    configured. User plugins are left to run once the whole cluster is up.
+    """
+
+    def __init__(self, cluster, spots, instances, reboot_interval,
+                 n_reboot_restart, save_config_on_master=False):
+        super(StreamingClusterStart, self).__init__(
+            cluster, spots, instances, reboot_interval, n_reboot_restart)
+        self.run_user_plugins = False
+        self.save_config_on_master = save_config_on_master
+        self.master_ready = False
+        self.waiting_workers = []
+
+    def stream_ready_instances(self):
+        if not self.master_ready:
+            masters = [i for i in self.ready_instances if i.is_master()]
+            workers = [i for i in self.ready_instances if not i.is_master()]
+            self.waiting_workers.extend(workers)
+            if not masters:
+                return
+            self.cluster.setup_master(self.save_config_on_master)
+            self.mark(masters, 'added')
+            del self.instances_nrm[masters[0].id]
+            self.master_ready = True
+            self.ready_instances = self.waiting_workers
+            self.waiting_workers = []
+        super(StreamingClusterStart, self).stream_ready_instances()
 
 
 class UnpropagatedInstance(object):
@@ -185,11 +399,11 @@ class UnpropagatedInstance(object):
 
 
 def streaming_add(cluster, spots=None, instances=None, reboot_interval=10,
-                  n_reboot_restart=False):
+                  n_reboot_restart=False, timeline_file=None):
     if spots is None:
         spots = []
     if instances is None:
         instances = []
     sna = StreamingNodeAdd(cluster, spots, instances, reboot_interval,
-                           n_reboot_restart)
+                           n_reboot_restart, timeline_file=timeline_file)
     sna.run()
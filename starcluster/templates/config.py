@@ -59,6 +59,17 @@ AWS_USER_ID= #your userid
 #AWS_PROXY_PORT = 8080
 #AWS_PROXY_USER = yourproxyuser
 #AWS_PROXY_PASS = yourproxypass
+# number of seconds DescribeInstances results are cached and shared between
+# repeated reads (default: 5s, 0 disables the cache)
+#AWS_INSTANCE_CACHE_TTL = 5
+# maximum average number of AWS API requests per second per region and the
+# size of the allowed bursts (defaults: 10 and 40). Throttled requests are
+# retried with exponential backoff.
+#AWS_REQUEST_RATE = 10
+#AWS_REQUEST_BURST = 40
+# maximum number of AWS connections used in parallel by worker threads
+# (default: 20)
+#AWS_MAX_CONNECTIONS = 20
 
 ###########################
 ## Defining EC2 Keypairs ##
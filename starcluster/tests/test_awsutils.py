@@ -0,0 +1,113 @@
+# Copyright 2009-2014 Justin Riley
+#
+# This file is part of StarCluster.
+#
+# StarCluster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# StarCluster is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
+
+from starcluster.awsutils import InstanceCache
+from starcluster.awsutils import PropagationWaiter
+from starcluster.awsutils import RequestGovernor
+
+SCOPE = ('key', 'us-east-1')
+
+
+def test_instance_cache_hit_and_miss():
+    cache = InstanceCache(ttl=60)
+    key = cache.make_key([], {'instance-state-name': ['running', 'pending']})
+    assert cache.get(SCOPE, key) is None
+    cache.put(SCOPE, key, ['i-1', 'i-2'])
+    same_key = cache.make_key([], {'instance-state-name': ['pending',
+                                                           'running']})
+    assert cache.get(SCOPE, same_key) == ['i-1', 'i-2']
+    assert cache.stats['hits'] == 1
+    assert cache.stats['misses'] == 1
+
+
+def test_instance_cache_invalidate():
+    cache = InstanceCache(ttl=60)
+    key = cache.make_key(['i-1'], None)
+    generation = cache.generation(SCOPE)
+    cache.put(SCOPE, key, ['i-1'], generation)
+    cache.invalidate(SCOPE)
+    assert cache.get(SCOPE, key) is None
+    # results fetched before an invalidation must not be stored
+    cache.put(SCOPE, key, ['i-1'], generation)
+    assert cache.get(SCOPE, key) is None
+
+
+def test_instance_cache_disabled():
+    cache = InstanceCache(ttl=0)
+    key = cache.make_key([], None)
+    cache.put(SCOPE, key, ['i-1'])
+    assert cache.get(SCOPE, key) is None
+
+
+class FakeResponse(object):
+    def __init__(self, status, body=''):
+        self.status = status
+        self.body = body
+
+    def read(self):
+        return self.body
+
+
+def test_request_governor_retries_throttled_requests():
+    governor = RequestGovernor(base_delay=0.01)
+    responses = [FakeResponse(503, '<Code>RequestLimitExceeded</Code>'),
+                 FakeResponse(400, '<Code>InvalidInstanceID</Code>')]
+    response = governor.request('us-east-1', responses.pop)
+    assert response.status == 400
+    assert governor.stats['requests'] == 1
+    responses = [FakeResponse(200),
+                 FakeResponse(503, '<Code>RequestLimitExceeded</Code>')]
+    response = governor.request('us-east-1', responses.pop)
+    assert response.status == 200
+    assert governor.stats['throttled'] == 1
+    assert governor.stats['retries'] == 1
+
+
+class FakeObject(object):
+    def __init__(self, id):
+        self.id = id
+
+
+class FakeEC2(object):
+    def __init__(self, visible):
+        self.visible = visible
+        self.calls = 0
+
+    def _get(self, filters):
+        self.calls += 1
+        ids = filters.values()[0]
+        return [FakeObject(i) for i in ids if i in self.visible]
+
+    def get_all_instances(self, filters=None, use_cache=True):
+        return self._get(filters)
+
+    def get_all_spot_requests(self, filters=None):
+        return self._get(filters)
+
+
+def test_propagation_waiter_multiplexes_kinds():
+    ec2 = FakeEC2(visible=['i-1', 'sir-1'])
+    waiter = PropagationWaiter(ec2, min_interval=0.01, timeout=0.05)
+    waiter.add('instance', ['i-1', 'i-2'])
+    waiter.add('spot', [FakeObject('sir-1')])
+    found = waiter.check()
+    assert sorted([obj.id for kind, obj in found]) == ['i-1', 'sir-1']
+    assert ec2.calls == 2
+    assert waiter.pending['instance'] == ['i-2']
+    ec2.visible.append('i-2')
+    assert [obj.id for kind, obj in waiter.iter_resolved()] == ['i-2']
+    assert waiter.num_pending == 0
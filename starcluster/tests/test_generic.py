@@ -15,10 +15,22 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import time
+import shutil
 import logging
+import tempfile
+import subprocess
+
+import paramiko
+
 logging.disable(logging.WARN)
 
 from starcluster import tests
+from starcluster import sshutils
+from starcluster import exception
+from starcluster import clustersetup
+from starcluster import streaming_node_add
 from starcluster.node import Node
 from starcluster.cluster import Cluster
 
@@ -33,6 +45,58 @@ class FooNode(Node):
         return self._private_ip_address
 
 
+class LocalChannel(object):
+    """
+    Mimics a paramiko channel running commands in a local process
+    """
+    closed = False
+
+    def settimeout(self, timeout):
+        pass
+
+    def exec_command(self, command):
+        self.proc = subprocess.Popen(command, shell=True,
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE)
+
+    def makefile(self, mode, bufsize):
+        if mode == 'wb':
+            return self.proc.stdin
+        return self.proc.stdout
+
+    def makefile_stderr(self, mode, bufsize):
+        return self.proc.stderr
+
+    def exit_status_ready(self):
+        return self.proc.poll() is not None
+
+    def recv_exit_status(self):
+        return self.proc.wait()
+
+    def close(self):
+        self.closed = True
+        self.proc.stdin.close()
+        self.proc.wait()
+
+
+class LocalTransport(object):
+    def open_session(self):
+        return LocalChannel()
+
+
+class LocalSSHClient(sshutils.SSHClient):
+    def __init__(self):
+        self._timeout = None
+        self._transport = LocalTransport()
+        self._session = None
+        self._sftp = None
+
+    @property
+    def transport(self):
+        return self._transport
+
+
 class TestStarClusterGeneric(tests.StarClusterTest):
 
     def test_filter_etc_hosts_lines(self):
@@ -71,3 +135,269 @@ class TestStarClusterGeneric(tests.StarClusterTest):
         res = Cluster.get_free_ids_among_nodes(5, [node001, node003, node005,
                                                    node006, node106])
         assert res == [2, 4, 7, 8, 9]
+
+    def test_get_batch_hook(self):
+        calls = []
+
+        class PerNodePlugin(clustersetup.DefaultClusterSetup):
+            def on_add_node(self, node, nodes, master, user, user_shell,
+                            volumes):
+                calls.append(node)
+
+        class BatchPlugin(PerNodePlugin):
+            def on_add_nodes(self, new_nodes, nodes, master, user,
+                             user_shell, volumes):
+                calls.append(new_nodes)
+
+        get_hook = clustersetup.get_batch_hook
+        args = [None, None, None, None, None]
+        get_hook(PerNodePlugin(), 'on_add_nodes')(['a', 'b'], *args)
+        assert calls == ['a', 'b']
+        calls = []
+        get_hook(BatchPlugin(), 'on_add_nodes')(['a', 'b'], *args)
+        assert calls == [['a', 'b']]
+        plugin = clustersetup.DefaultClusterSetup()
+        assert get_hook(plugin, 'on_add_nodes') == plugin.on_add_nodes
+        assert get_hook(plugin, 'on_remove_nodes') == plugin.on_remove_nodes
+        assert get_hook(object(), 'on_add_nodes') is None
+
+    def test_plugin_deps(self):
+        def plugin(name, requires=None, after=None):
+            plug = clustersetup.ClusterSetup()
+            plug.__name__ = name
+            plug.requires = requires or []
+            plug.after = after or []
+            return plug
+        plugs = [plugin('default'), plugin('sge'), plugin('pkgs'),
+                 plugin('pypkgs', requires=['pkgs']), plugin('tagger'),
+                 plugin('s3fs', after=['tagger', 'missing'])]
+        deps = clustersetup.get_plugin_deps(plugs, num_builtin=2)
+        assert deps == [set(), set([0]), set([0, 1]), set([0, 1, 2]),
+                        set([0, 1, 2, 3]), set([0, 1, 4])]
+        order, deps = clustersetup.get_plugin_order(plugs, deps)
+        assert order == [0, 1, 2, 3, 4, 5]
+        order, rdeps = clustersetup.get_plugin_order(plugs, deps,
+                                                     reverse=True)
+        assert order == [5, 4, 3, 2, 1, 0]
+        assert rdeps[4] == set([5])
+        # undeclared plugins listed after a plugin that must run after them
+        plugs = [plugin('default'), plugin('a', after=['b']), plugin('b')]
+        deps = clustersetup.get_plugin_deps(plugs, num_builtin=1)
+        assert deps == [set(), set([0, 2]), set([0])]
+        order, deps = clustersetup.get_plugin_order(plugs, deps)
+        assert order == [0, 2, 1]
+        plugs = [plugin('a', after=['b']), plugin('b', after=['a'])]
+        deps = clustersetup.get_plugin_deps(plugs)
+        self.assertRaises(exception.PluginError,
+                          clustersetup.get_plugin_order, plugs, deps)
+        self.assertRaises(exception.PluginError,
+                          clustersetup.get_plugin_deps,
+                          [plugin('a', requires=['missing'])])
+        deps = clustersetup.get_plugin_deps(
+            [plugin('a', requires=['sge'])], satisfied=['sge'])
+        assert deps == [set()]
+
+    def test_get_nodes(self):
+        nodes = []
+        for i, alias in enumerate(['master', 'node001', 'node002']):
+            node = FooNode(alias, None)
+            node.instance = type('Instance', (), dict(
+                id='i-' + alias, ip_address=None, dns_name=None,
+                public_dns_name=None, private_dns_name=alias + '.ec2',
+                private_ip_address='10.0.0.%d' % i,
+                spot_instance_request_id=None))
+            node._private_ip_address = node.instance.private_ip_address
+            node._ssh = None
+            nodes.append(node)
+        cl = Cluster()
+        found = cl.get_nodes(['node001', 'i-master', 'node001.ec2',
+                              '10.0.0.0', 'node002'], nodes=nodes)
+        assert found == [nodes[1], nodes[0], nodes[2]]
+        # stale index entries are detected and the index is rebuilt
+        nodes[1]._private_ip_address = '10.0.0.9'
+        nodes[2]._private_ip_address = '10.0.0.1'
+        assert cl.get_node('10.0.0.9', nodes=nodes) is nodes[1]
+        assert cl.get_node('10.0.0.1', nodes=nodes) is nodes[2]
+        self.assertRaises(exception.InstanceDoesNotExist, cl.get_node,
+                          '10.0.0.2', nodes=nodes)
+
+    def test_execute_on_nodes(self):
+        class FakeSSH(object):
+            def __init__(self, alias):
+                self.alias = alias
+
+            def execute(self, command, **kwargs):
+                if self.alias == 'node001':
+                    raise exception.RemoteCommandFailed(
+                        'failed', command, 2, 'oops\nbad')
+                if self.alias == 'node002':
+                    raise exception.SSHConnectionError('node002', 22)
+                if self.alias == 'node003':
+                    time.sleep(5)
+                return [command]
+
+        nodes = []
+        for alias in ['master', 'node001', 'node002', 'node003']:
+            node = FooNode(alias, None)
+            node.instance = type('Instance', (), dict(id='i-' + alias))
+            node._ssh = FakeSSH(alias)
+            nodes.append(node)
+        results = Cluster().execute_on_nodes('hostname', nodes=nodes,
+                                             timeout=2)
+        results = dict([(n.alias, (s, o)) for n, s, o in results])
+        assert results['master'] == (0, ['hostname'])
+        assert results['node001'] == (2, ['oops', 'bad'])
+        assert results['node002'][0] is None
+        assert results['node003'] == (None, ['timed out after 2 seconds'])
+
+    def test_execute_on_nodes_stops_on_timeout(self):
+        started = []
+
+        class SlowSSH(object):
+            def __init__(self, alias):
+                self.alias = alias
+
+            def execute(self, command, **kwargs):
+                started.append(self.alias)
+                time.sleep(3)
+                return [command]
+
+            def close(self):
+                pass
+
+        nodes = []
+        for alias in ['master', 'node001', 'node002']:
+            node = FooNode(alias, None)
+            node.instance = type('Instance', (), dict(id='i-' + alias))
+            node._ssh = SlowSSH(alias)
+            nodes.append(node)
+        results = list(Cluster().execute_on_nodes(
+            'hostname', nodes=nodes, concurrency=1, timeout=1))
+        time.sleep(3.5)
+        assert started == ['master']
+        assert [(n.alias, s, o) for n, s, o in results] == [
+            ('master', None, ['timed out after 1 seconds']),
+            ('node001', None, ['not started after 1 seconds']),
+            ('node002', None, ['not started after 1 seconds'])]
+
+    def test_remote_batch(self):
+        class LocalSSH(object):
+            def execute(self, command, **kwargs):
+                proc = subprocess.Popen(['bash', '-c', command],
+                                        stdout=subprocess.PIPE)
+                output = proc.communicate()[0]
+                self.status = proc.returncode
+                return [line.strip() for line in output.splitlines()]
+
+            def get_last_status(self):
+                return self.status
+
+        with sshutils.RemoteBatch(LocalSSH()) as batch:
+            batch.add('echo one; echo two')
+            batch.add('echo -n three; false', ignore_exit_status=True)
+            batch.write_file('/dev/null', "it's (ro)")
+            batch.add('echo err >&2')
+        assert batch.results == [(0, ['one', 'two']), (1, ['three']),
+                                 (0, []), (0, ['err'])]
+        batch = sshutils.RemoteBatch(LocalSSH())
+        batch.add('exit 3')
+        batch.add('echo never')
+        try:
+            batch.run()
+            assert False, "should have raised RemoteCommandFailed"
+        except exception.RemoteCommandFailed as e:
+            assert e.exit_status == 3
+            assert e.command == 'exit 3'
+        assert batch.results == [(3, []), (None, [])]
+
+    def test_remote_shell(self):
+        shell = sshutils.RemoteShell(LocalTransport())
+        status, output = shell.run('echo one; echo two >&2')
+        assert (status, output) == (0, ['one\n', 'two\n'])
+        # commands do not share state or read the shell's stdin
+        status, output = shell.run('cd /; read x; echo -n $x$PWD; exit 3')
+        assert (status, output) == (3, ['/\n'])
+        assert shell.run('pwd')[1] != ['/\n']
+        assert shell.run('echo "unbalanced')[0] == 2
+        assert shell.run('true') == (0, [])
+        assert shell.is_active()
+        shell.close()
+        assert not shell.is_active()
+
+    def test_remote_shell_profile_changes(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            profile = os.path.join(tmpdir, 'profile')
+            profile_dir = os.path.join(tmpdir, 'profile.d')
+            os.mkdir(profile_dir)
+            with open(profile, 'w') as f:
+                f.write('for i in %s/*.sh; do [ -r $i ] && . $i; done\n' %
+                        profile_dir)
+            shell = sshutils.RemoteShell(LocalTransport(), profile=profile,
+                                         profile_dir=profile_dir)
+            assert shell.run('echo $SGE_ROOT') == (0, ['\n'])
+            # scripts written to profile.d are picked up by the next command
+            script = os.path.join(profile_dir, 'sge.sh')
+            with open(script, 'w') as f:
+                f.write('export SGE_ROOT=/opt/sge6\n')
+            assert shell.run('echo $SGE_ROOT') == (0, ['/opt/sge6\n'])
+            with open(script, 'w') as f:
+                f.write('export SGE_ROOT=/opt/sge6-new\n')
+            assert shell.run('echo $SGE_ROOT') == (0, ['/opt/sge6-new\n'])
+            shell.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_execute_iter(self):
+        ssh = LocalSSHClient()
+        cmd = ("for i in $(seq 5000); do echo err$i >&2; done; "
+               "for i in $(seq 3000); do echo out$i; done")
+        lines = list(ssh.execute_iter(cmd, source_profile=False,
+                                      max_buffered_lines=10))
+        assert len(lines) == 3000
+        assert lines[0] == 'out1\n' and lines[-1] == 'out3000\n'
+        assert ssh.get_last_status() == 0
+        lines = list(ssh.execute_iter('echo out; echo err >&2',
+                                      source_profile=False, stderr=True))
+        assert sorted(lines) == ['err\n', 'out\n']
+        try:
+            list(ssh.execute_iter('echo out; echo err >&2; exit 4',
+                                  source_profile=False))
+            assert False, "should have raised RemoteCommandFailed"
+        except exception.RemoteCommandFailed as e:
+            assert e.exit_status == 4
+            assert e.output == 'err\n'
+        lines = list(ssh.execute_iter('exit 4', source_profile=False,
+                                      ignore_exit_status=True))
+        assert lines == []
+
+    def test_private_key_cache(self):
+        key = paramiko.RSAKey.generate(1024)
+        with tempfile.NamedTemporaryFile(suffix='_rsa') as f:
+            key.write_private_key_file(f.name)
+            ssh1 = sshutils.SSHClient('localhost', username='root',
+                                      private_key=f.name)
+            ssh2 = sshutils.SSHClient('localhost', username='root',
+                                      private_key=f.name)
+            assert ssh1._pkey is ssh2._pkey
+            assert ssh1._pkey == key
+            mtime = os.stat(f.name).st_mtime
+            os.utime(f.name, (mtime + 10, mtime + 10))
+            ssh3 = sshutils.SSHClient('localhost', username='root',
+                                      private_key=f.name)
+            assert ssh3._pkey is not ssh1._pkey
+            assert ssh3._pkey == key
+
+    def test_summarize_timeline(self):
+        timeline = {}
+        for i in range(1, 21):
+            events = dict(start=0, instance_propagated=1, running=1 + i,
+                          ssh_up=2 + i, added=12 + i)
+            timeline['i-%d' % i] = dict(id='i-%d' % i, events=events)
+        timeline['i-x'] = dict(id='i-x', events=dict(start=0))
+        summary = streaming_node_add.summarize_timeline(timeline)
+        assert 'spot_propagation' not in summary
+        assert summary['instance_propagation'] == (20, 1, 1, 1)
+        assert summary['boot'] == (20, 11, 19, 20)
+        assert summary['plugins'] == (20, 10, 10, 10)
+        assert summary['total'] == (20, 23, 31, 32)
@@ -0,0 +1,48 @@
+# Copyright 2009-2014 Justin Riley
+#
+# This file is part of StarCluster.
+#
+# StarCluster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# StarCluster is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
+import shutil
+import tempfile
+
+from starcluster.receiptcache import ReceiptCache
+
+
+class FakeGroup(object):
+    def __init__(self, id, tags):
+        self.id = id
+        self.tags = tags
+
+
+def test_receipt_cache_invalidation():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        cache = ReceiptCache(tmpdir)
+        group = FakeGroup('sg-1234', {'@sc-cluster': 'abc'})
+        assert cache.get('mycluster', group, 'i-1') is None
+        assert not cache.has('mycluster', group)
+        cache.put('mycluster', group, 'i-1', dict(settings={'a': 1}))
+        assert cache.get('mycluster', group, 'i-1') == dict(settings={'a': 1})
+        # new master
+        assert cache.get('mycluster', group, 'i-2') is None
+        # tags changed
+        group.tags['@sc-plugins'] = 'xyz'
+        assert cache.get('mycluster', group, 'i-1') is None
+        assert cache.has('mycluster', group)
+        cache.invalidate('mycluster', group)
+        assert not cache.has('mycluster', group)
+        cache.invalidate('mycluster', group)
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,60 @@
+# Copyright 2009-2014 Justin Riley
+#
+# This file is part of StarCluster.
+#
+# StarCluster is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# StarCluster is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with StarCluster. If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import shutil
+import tempfile
+
+from starcluster import utils
+from starcluster.spotstore import SpotPriceStore
+
+
+class FakePrice(object):
+    def __init__(self, secs, price, zone='us-east-1a'):
+        self.timestamp = utils.unix_time_to_iso(secs)
+        self.price = price
+        self.availability_zone = zone
+
+
+def test_spot_price_store_incremental():
+    now = int(time.time())
+    fetches = []
+    prices = [FakePrice(now - 7200, 0.02), FakePrice(now - 3600, 0.03)]
+
+    def fetch(start, end):
+        fetches.append((start, end))
+        return prices
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        store = SpotPriceStore(tmpdir, max_age=0)
+        hist = store.get_history(fetch, 'us-east-1', 'm1.small', 'Linux/UNIX')
+        assert [h[1] for h in hist] == [0.03, 0.02]
+        assert len(fetches) == 1
+        # only data newer than the last fetch is requested
+        prices = [FakePrice(now - 3600, 0.03), FakePrice(now, 0.04)]
+        hist = store.get_history(fetch, 'us-east-1', 'm1.small', 'Linux/UNIX')
+        assert [h[1] for h in hist] == [0.04, 0.03, 0.02]
+        assert utils.iso_to_unix_time(fetches[1][0]) >= now - 1
+        # fresh series are served from disk without fetching
+        store = SpotPriceStore(tmpdir, max_age=300)
+        hist = store.get_history(fetch, 'us-east-1', 'm1.small', 'Linux/UNIX',
+                                 start=now - 1800)
+        assert [h[1] for h in hist] == [0.04, 0.03]
+        assert len(fetches) == 2
+    finally:
+        shutil.rmtree(tmpdir)
@@ -286,6 +286,14 @@ def iso_to_unix_time(iso):
     return secs
 
 
+def unix_time_to_iso(secs):
+    """
+    Converts unix time (seconds since the epoch) to a UTC iso time string
+    """
+    dtup = datetime.utcfromtimestamp(secs).replace(tzinfo=iso8601.iso8601.UTC)
+    return datetime_tuple_to_iso(dtup)
+
+
 def iso_to_javascript_timestamp(iso):
     """
     Convert dates to Javascript timestamps (number of milliseconds since